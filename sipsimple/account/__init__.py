@@ -6,7 +6,6 @@ multiple SIP accounts and their properties.
 
 __all__ = ['Account', 'BonjourAccount', 'AccountManager']
 
-from itertools import chain
 from threading import Lock
 
 from application.notification import IObserver, NotificationCenter, NotificationData
@@ -23,12 +22,14 @@ from zope.interface import implements
 from sipsimple.account.bonjour import BonjourServices, _bonjour
 from sipsimple.account.publication import PresencePublisher, DialogPublisher
 from sipsimple.account.registration import Registrar
+from sipsimple.account.state import MergedState
 from sipsimple.account.subscription import MWISubscriber, PresenceWinfoSubscriber, DialogWinfoSubscriber, PresenceSubscriber, SelfPresenceSubscriber, DialogSubscriber
 from sipsimple.account.xcap import XCAPManager
 from sipsimple.core import Credentials, SIPURI, ContactURIFactory
 from sipsimple.configuration import ConfigurationManager, Setting, SettingsGroup, SettingsObject, SettingsObjectID
 from sipsimple.configuration.datatypes import AudioCodecList, MSRPConnectionModel, MSRPRelayAddress, MSRPTransport, NonNegativeInteger, Path, SIPAddress, SIPProxyAddress, SRTPKeyNegotiation, STUNServerAddressList, VideoCodecList, XCAPRoot
 from sipsimple.configuration.settings import SIPSimpleSettings
+from sipsimple.lookup import DNSLookup
 from sipsimple.payloads import ParserError
 from sipsimple.payloads.messagesummary import MessageSummary
 from sipsimple.payloads.pidf import PIDFDocument
@@ -164,10 +165,10 @@ class Account(SettingsObject):
         self._presence_publisher = PresencePublisher(self)
         self._dialog_publisher = DialogPublisher(self)
         self._mwi_voicemail_uri = None
-        self._pwi_version = None
-        self._dwi_version = None
-        self._presence_version = None
-        self._dialog_version = None
+        self._pwi_state = MergedState(comparison_key=self._watcher_state)
+        self._dwi_state = MergedState(comparison_key=self._watcher_state)
+        self._presence_rls_state = MergedState()
+        self._dialog_rls_state = MergedState()
 
     def start(self):
         if self._started or self._deleted:
@@ -283,6 +284,26 @@ class Account(SettingsObject):
     def uri(self):
         return SIPURI(user=self.id.username, host=self.id.domain)
 
+    @property
+    def presence_watchers(self):
+        """The merged state of the presence watcher-info subscription, mapping watcher IDs to watchers"""
+        return self._pwi_state.snapshot()
+
+    @property
+    def dialog_watchers(self):
+        """The merged state of the dialog watcher-info subscription, mapping watcher IDs to watchers"""
+        return self._dwi_state.snapshot()
+
+    @property
+    def presence_resources(self):
+        """The merged state of the presence RLS subscription, mapping resource URIs to resources"""
+        return self._presence_rls_state.snapshot()
+
+    @property
+    def dialog_resources(self):
+        """The merged state of the dialog RLS subscription, mapping resource URIs to resources"""
+        return self._dialog_rls_state.snapshot()
+
     @property
     def voicemail_uri(self):
         return self._mwi_voicemail_uri or self.message_summary.voicemail_uri
@@ -317,6 +338,11 @@ class Account(SettingsObject):
     dialog_state = property(_get_dialog_state, _set_dialog_state)
     del _get_dialog_state, _set_dialog_state
 
+    @staticmethod
+    def _watcher_state(watcher):
+        # watchers compare equal when their URIs do, their status and event must be compared as well
+        return watcher.sipuri, watcher.status, watcher.event, watcher.display_name
+
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
@@ -358,22 +384,22 @@ class Account(SettingsObject):
             else:
                 if watcher_list.package != 'presence':
                     return
-                if self._pwi_version is None:
+                if self._pwi_state.version is None:
                     if watcher_info.state == 'partial':
                         self._pwi_subscriber.resubscribe()
-                elif watcher_info.version <= self._pwi_version:
+                elif watcher_info.version <= self._pwi_state.version:
                     return
-                elif watcher_info.state == 'partial' and watcher_info.version > self._pwi_version + 1:
+                elif watcher_info.state == 'partial' and watcher_info.version > self._pwi_state.version + 1:
                     self._pwi_subscriber.resubscribe()
-                self._pwi_version = watcher_info.version
-                data = NotificationData(version=watcher_info.version, state=watcher_info.state, watcher_list=watcher_list)
+                changed_watchers = self._pwi_state.update(watcher_info.version, watcher_info.state == 'full', ((watcher.id, watcher) for watcher in watcher_list))
+                data = NotificationData(version=watcher_info.version, state=watcher_info.state, watcher_list=watcher_list, changed_watchers=changed_watchers)
                 notification.center.post_notification('SIPAccountGotPresenceWinfo', sender=self, data=data)
 
     def _NH_PresenceWinfoSubscriptionDidEnd(self, notification):
-        self._pwi_version = None
+        self._pwi_state.reset()
 
     def _NH_PresenceWinfoSubscriptionDidFail(self, notification):
-        self._pwi_version = None
+        self._pwi_state.reset()
 
     def _NH_DialogWinfoSubscriptionGotNotify(self, notification):
         if notification.data.body and notification.data.content_type == WatcherInfoDocument.content_type:
@@ -385,22 +411,22 @@ class Account(SettingsObject):
             else:
                 if watcher_list.package != 'dialog':
                     return
-                if self._dwi_version is None:
+                if self._dwi_state.version is None:
                     if watcher_info.state == 'partial':
                         self._dwi_subscriber.resubscribe()
-                elif watcher_info.version <= self._dwi_version:
+                elif watcher_info.version <= self._dwi_state.version:
                     return
-                elif watcher_info.state == 'partial' and watcher_info.version > self._dwi_version + 1:
+                elif watcher_info.state == 'partial' and watcher_info.version > self._dwi_state.version + 1:
                     self._dwi_subscriber.resubscribe()
-                self._dwi_version = watcher_info.version
-                data = NotificationData(version=watcher_info.version, state=watcher_info.state, watcher_list=watcher_list)
+                changed_watchers = self._dwi_state.update(watcher_info.version, watcher_info.state == 'full', ((watcher.id, watcher) for watcher in watcher_list))
+                data = NotificationData(version=watcher_info.version, state=watcher_info.state, watcher_list=watcher_list, changed_watchers=changed_watchers)
                 notification.center.post_notification('SIPAccountGotDialogWinfo', sender=self, data=data)
 
     def _NH_DialogWinfoSubscriptionDidEnd(self, notification):
-        self._dwi_version = None
+        self._dwi_state.reset()
 
     def _NH_DialogWinfoSubscriptionDidFail(self, notification):
-        self._dwi_version = None
+        self._dwi_state.reset()
 
     def _NH_PresenceSubscriptionGotNotify(self, notification):
         if notification.data.body and notification.data.content_type == RLSNotify.content_type:
@@ -411,22 +437,23 @@ class Account(SettingsObject):
             else:
                 if rls_notify.uri != self.xcap_manager.rls_presence_uri:
                     return
-                if self._presence_version is None:
+                if self._presence_rls_state.version is None:
                     if not rls_notify.full_state:
                         self._presence_subscriber.resubscribe()
-                elif rls_notify.version <= self._presence_version:
+                elif rls_notify.version <= self._presence_rls_state.version:
                     return
-                elif not rls_notify.full_state and rls_notify.version > self._presence_version + 1:
+                elif not rls_notify.full_state and rls_notify.version > self._presence_rls_state.version + 1:
                     self._presence_subscriber.resubscribe()
-                self._presence_version = rls_notify.version
-                data = NotificationData(version=rls_notify.version, full_state=rls_notify.full_state, resource_map=dict((resource.uri, resource) for resource in rls_notify))
+                resource_map = dict((resource.uri, resource) for resource in rls_notify)
+                changed_resources = self._presence_rls_state.update(rls_notify.version, rls_notify.full_state, resource_map.iteritems())
+                data = NotificationData(version=rls_notify.version, full_state=rls_notify.full_state, resource_map=resource_map, changed_resources=changed_resources)
                 notification.center.post_notification('SIPAccountGotPresenceState', sender=self, data=data)
 
     def _NH_PresenceSubscriptionDidEnd(self, notification):
-        self._presence_version = None
+        self._presence_rls_state.reset()
 
     def _NH_PresenceSubscriptionDidFail(self, notification):
-        self._presence_version = None
+        self._presence_rls_state.reset()
 
     def _NH_SelfPresenceSubscriptionGotNotify(self, notification):
         if notification.data.body and notification.data.content_type == PIDFDocument.content_type:
@@ -448,22 +475,23 @@ class Account(SettingsObject):
             else:
                 if rls_notify.uri != self.xcap_manager.rls_dialog_uri:
                     return
-                if self._dialog_version is None:
+                if self._dialog_rls_state.version is None:
                     if not rls_notify.full_state:
                         self._dialog_subscriber.resubscribe()
-                elif rls_notify.version <= self._dialog_version:
+                elif rls_notify.version <= self._dialog_rls_state.version:
                     return
-                elif not rls_notify.full_state and rls_notify.version > self._dialog_version + 1:
+                elif not rls_notify.full_state and rls_notify.version > self._dialog_rls_state.version + 1:
                     self._dialog_subscriber.resubscribe()
-                self._dialog_version = rls_notify.version
-                data = NotificationData(version=rls_notify.version, full_state=rls_notify.full_state, resource_map=dict((resource.uri, resource) for resource in rls_notify))
+                resource_map = dict((resource.uri, resource) for resource in rls_notify)
+                changed_resources = self._dialog_rls_state.update(rls_notify.version, rls_notify.full_state, resource_map.iteritems())
+                data = NotificationData(version=rls_notify.version, full_state=rls_notify.full_state, resource_map=resource_map, changed_resources=changed_resources)
                 notification.center.post_notification('SIPAccountGotDialogState', sender=self, data=data)
 
     def _NH_DialogSubscriptionDidEnd(self, notification):
-        self._dialog_version = None
+        self._dialog_rls_state.reset()
 
     def _NH_DialogSubscriptionDidFail(self, notification):
-        self._dialog_version = None
+        self._dialog_rls_state.reset()
 
     def _activate(self):
         with self._activation_lock:
@@ -717,6 +745,13 @@ class AccountManager(object):
     def __init__(self):
         self._lock = Lock()
         self.accounts = {}
+        # The indexes used by find_account map usernames to tuples of accounts. The tuples are replaced rather than
+        # modified, so that lookups need no locking. The contact index holds the contact and GRUU usernames and the
+        # username index holds the usernames from the account IDs.
+        self._index_lock = Lock()
+        self._contact_index = {}
+        self._username_index = {}
+        self._gruu_usernames = {}
         notification_center = NotificationCenter()
         notification_center.add_observer(self, name='CFGSettingsObjectWasActivated')
         notification_center.add_observer(self, name='CFGSettingsObjectWasCreated')
@@ -745,6 +780,11 @@ class AccountManager(object):
         """
         notification_center = NotificationCenter()
         notification_center.post_notification('SIPAccountManagerWillStart', sender=self)
+        # accounts usually share a few registrars, so look them up once instead of once for each account
+        settings = SIPSimpleSettings()
+        uris = [Registrar.get_lookup_uri(account) for account in self.accounts.itervalues() if isinstance(account, Account) and account.enabled and account.sip.register]
+        if uris:
+            DNSLookup().prefetch(uris, settings.sip.transport_list)
         proc.waitall([proc.spawn(account.start) for account in self.accounts.itervalues()])
         notification_center.post_notification('SIPAccountManagerDidStart', sender=self)
 
@@ -772,11 +812,12 @@ class AccountManager(object):
         return self.accounts.itervalues()
 
     def find_account(self, contact_uri):
-        # compare contact_address with account contact
-        exact_matches = (account for account in self.accounts.itervalues() if account.enabled and account.contact.username==contact_uri.user)
-        # compare username in contact URI with account username
-        loose_matches = (account for account in self.accounts.itervalues() if account.enabled and account.id.username==contact_uri.user)
-        return chain(exact_matches, loose_matches, [None]).next()
+        # compare username in contact URI with account contact and GRUUs first and with account username next
+        for index in (self._contact_index, self._username_index):
+            for account in index.get(contact_uri.user, ()):
+                if account.enabled:
+                    return account
+        return None
 
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
@@ -786,8 +827,14 @@ class AccountManager(object):
         if isinstance(notification.sender, Account) or (isinstance(notification.sender, BonjourAccount) and _bonjour.available):
             account = notification.sender
             self.accounts[account.id] = account
+            with self._index_lock:
+                self._add_to_index(self._contact_index, account.contact.username, account)
+                self._add_to_index(self._username_index, account.id.username, account)
             notification.center.add_observer(self, sender=account, name='CFGSettingsObjectDidChange')
             notification.center.add_observer(self, sender=account, name='CFGSettingsObjectWasDeleted')
+            notification.center.add_observer(self, sender=account, name='SIPAccountRegistrationDidSucceed')
+            notification.center.add_observer(self, sender=account, name='SIPAccountRegistrationDidFail')
+            notification.center.add_observer(self, sender=account, name='SIPAccountRegistrationDidEnd')
             notification.center.post_notification('SIPAccountManagerDidAddAccount', sender=self, data=NotificationData(account=account))
             from sipsimple.application import SIPApplication
             if SIPApplication.running:
@@ -802,8 +849,16 @@ class AccountManager(object):
     def _NH_CFGSettingsObjectWasDeleted(self, notification):
         account = notification.sender
         del self.accounts[account.id]
+        with self._index_lock:
+            self._remove_from_index(self._contact_index, account.contact.username, account)
+            self._remove_from_index(self._username_index, account.id.username, account)
+            for username in self._gruu_usernames.pop(account, ()):
+                self._remove_from_index(self._contact_index, username, account)
         notification.center.remove_observer(self, sender=account, name='CFGSettingsObjectDidChange')
         notification.center.remove_observer(self, sender=account, name='CFGSettingsObjectWasDeleted')
+        notification.center.remove_observer(self, sender=account, name='SIPAccountRegistrationDidSucceed')
+        notification.center.remove_observer(self, sender=account, name='SIPAccountRegistrationDidFail')
+        notification.center.remove_observer(self, sender=account, name='SIPAccountRegistrationDidEnd')
         notification.center.post_notification('SIPAccountManagerDidRemoveAccount', sender=self, data=NotificationData(account=account))
 
     def _NH_CFGSettingsObjectDidChange(self, notification):
@@ -811,6 +866,9 @@ class AccountManager(object):
         if '__id__' in notification.data.modified:
             modified_id = notification.data.modified['__id__']
             self.accounts[modified_id.new] = self.accounts.pop(modified_id.old)
+            with self._index_lock:
+                self._remove_from_index(self._username_index, modified_id.old.username, account)
+                self._add_to_index(self._username_index, modified_id.new.username, account)
         if 'enabled' in notification.data.modified:
             if account.enabled and self.default_account is None:
                 self.default_account = account
@@ -820,6 +878,40 @@ class AccountManager(object):
                 except StopIteration:
                     self.default_account = None
 
+    def _NH_SIPAccountRegistrationDidSucceed(self, notification):
+        account = notification.sender
+        usernames = set(gruu.user for gruu in (account.contact.public_gruu, account.contact.temporary_gruu) if gruu is not None and gruu.user)
+        usernames.discard(account.contact.username)
+        self._update_gruu_index(account, usernames)
+
+    def _NH_SIPAccountRegistrationDidFail(self, notification):
+        self._update_gruu_index(notification.sender, set())
+
+    def _NH_SIPAccountRegistrationDidEnd(self, notification):
+        self._update_gruu_index(notification.sender, set())
+
+    def _update_gruu_index(self, account, usernames):
+        with self._index_lock:
+            old_usernames = self._gruu_usernames.pop(account, set())
+            for username in old_usernames - usernames:
+                self._remove_from_index(self._contact_index, username, account)
+            for username in usernames - old_usernames:
+                self._add_to_index(self._contact_index, username, account)
+            if usernames:
+                self._gruu_usernames[account] = usernames
+
+    @staticmethod
+    def _add_to_index(index, username, account):
+        index[username] = index.get(username, ()) + (account,)
+
+    @staticmethod
+    def _remove_from_index(index, username, account):
+        accounts = tuple(item for item in index.get(username, ()) if item is not account)
+        if accounts:
+            index[username] = accounts
+        else:
+            index.pop(username, None)
+
     def _get_default_account(self):
         settings = SIPSimpleSettings()
         return self.accounts.get(settings.default_account, None)
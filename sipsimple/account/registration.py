@@ -1,14 +1,18 @@
 
 """Implements the registration handler"""
 
-__all__ = ['Registrar']
+__all__ = ['Registrar', 'RegistrationScheduler']
 
+import heapq
 import random
 
+from itertools import count
 from time import time
 
+from application import log
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null, limit
+from application.python.types import Singleton
 from eventlib import coros, proc
 from twisted.internet import reactor
 from zope.interface import implements
@@ -39,6 +43,185 @@ class RegistrationError(Exception):
         self.refresh_interval = refresh_interval
 
 
+class SchedulerEntry(object):
+    __slots__ = ('registrar', 'due', 'priority', 'reregister', 'command', 'queued')
+
+    def __init__(self, registrar, due, priority, reregister, command, queued):
+        self.registrar = registrar
+        self.due = due
+        self.priority = priority
+        self.reregister = reregister
+        self.command = command
+        self.queued = queued
+
+
+class RegistrationScheduler(object):
+    """
+    Decides when the registrars of all the accounts send their REGISTER
+    requests, so that starting many accounts at once or a change in the
+    network conditions does not result in all of them registering at the same
+    time.
+
+    Each registrar has at most one pending request in the scheduler. A new
+    request for a registrar that already has one is merged with it: the merged
+    request is due at the earliest of the two times and gets the highest of
+    the two priorities. The requests that are due are started with the ones
+    for registrations that are about to expire first, followed by the ones for
+    new registrations and retries and then by the early refreshes. If the
+    sip.register_rate_limit setting is set, at most that many requests are
+    started per second, with bursts of up to sip.register_burst, otherwise
+    all the requests are started as soon as they are due. Refreshes are
+    scheduled at a random point within refresh_window (expressed as fractions
+    of the registration duration) in order to spread out the refreshes of the
+    registrations which were made at the same time.
+    """
+
+    __metaclass__ = Singleton
+
+    implements(IObserver)
+
+    # priorities
+    Expiring = 0
+    Register = 1
+    Refresh = 2
+
+    refresh_window = (0.75, 0.95)
+    network_change_delay = 1
+
+    def __init__(self):
+        self.registrars = set()
+        self.entries = {}
+        self.started_requests = 0
+        self.total_latency = 0
+        self.max_latency = 0
+        self._waiting = []
+        self._ready = []
+        self._sequence = count()
+        self._release_time = 0
+        self._timer = None
+        self._network_change_timer = None
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='NetworkConditionsDidChange')
+        notification_center.add_observer(self, name='CFGSettingsObjectDidChange', sender=SIPSimpleSettings())
+
+    @property
+    def statistics(self):
+        """
+        The number of pending requests, how many of them are due and waiting
+        for the rate limit, how many requests were started and the mean and
+        maximum time they waited after becoming due (in seconds)
+        """
+        now = reactor.seconds()
+        return dict(queue_depth=len(self.entries), due=sum(1 for entry in self.entries.itervalues() if entry.due <= now), started=self.started_requests,
+                    mean_latency=self.total_latency/self.started_requests if self.started_requests else 0, max_latency=self.max_latency)
+
+    @run_in_twisted_thread
+    def add(self, registrar):
+        self.registrars.add(registrar)
+
+    @run_in_twisted_thread
+    def remove(self, registrar):
+        self.registrars.discard(registrar)
+        self._drop(registrar)
+
+    @run_in_twisted_thread
+    def schedule(self, registrar, delay=0, priority=Register, reregister=False, command=None):
+        now = reactor.seconds()
+        entry = SchedulerEntry(registrar, now + delay, priority, reregister, command, now)
+        old_entry = self.entries.get(registrar)
+        if old_entry is not None:
+            entry.due = min(entry.due, old_entry.due)
+            entry.priority = min(entry.priority, old_entry.priority)
+            entry.reregister = entry.reregister or old_entry.reregister
+            entry.command = entry.command or old_entry.command
+            entry.queued = min(entry.queued, old_entry.queued)
+        self.entries[registrar] = entry
+        heapq.heappush(self._waiting, (entry.due, next(self._sequence), entry))
+        self._process()
+
+    def schedule_refresh(self, registrar, expires):
+        # refresh before the core warns that the registration is about to expire, which happens 30 seconds before
+        delay = min(expires * random.uniform(*self.refresh_window), expires - 40)
+        if delay > 0:
+            self.schedule(registrar, delay=delay, priority=self.Refresh)
+
+    @run_in_twisted_thread
+    def cancel(self, registrar):
+        self._drop(registrar)
+
+    def _drop(self, registrar):
+        entry = self.entries.pop(registrar, None)
+        if entry is not None:
+            log.debug('Dropped the pending registration request for %s' % registrar.account.id)
+
+    def _process(self):
+        now = reactor.seconds()
+        settings = SIPSimpleSettings()
+        if settings.sip.register_rate_limit is not None:
+            interval = 1.0 / settings.sip.register_rate_limit
+            max_burst = settings.sip.register_burst
+        else:
+            # without a rate limit, all the requests which are due are started right away
+            interval = 0
+            max_burst = 1
+            self._release_time = min(self._release_time, now)
+        while self._waiting and self._waiting[0][0] <= now:
+            due, sequence, entry = heapq.heappop(self._waiting)
+            if self.entries.get(entry.registrar) is entry:
+                heapq.heappush(self._ready, (entry.priority, entry.due, sequence, entry))
+        # The rate is limited by keeping track of the time at which the next request could be started if there were
+        # no bursts. Up to max_burst requests can be started ahead of that time.
+        while self._ready and now >= self._release_time - (max_burst - 1) * interval:
+            priority, due, sequence, entry = heapq.heappop(self._ready)
+            if self.entries.get(entry.registrar) is not entry:
+                continue
+            del self.entries[entry.registrar]
+            self._release_time = max(self._release_time, now) + interval
+            latency = now - max(entry.due, entry.queued)
+            self.started_requests += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            entry.registrar._start_registration(entry.reregister, entry.command)
+        # discard the cancelled and replaced entries from the top of the queues, so that they do not trigger the timer
+        while self._ready and self.entries.get(self._ready[0][3].registrar) is not self._ready[0][3]:
+            heapq.heappop(self._ready)
+        while self._waiting and self.entries.get(self._waiting[0][2].registrar) is not self._waiting[0][2]:
+            heapq.heappop(self._waiting)
+        if self._ready:
+            next_time = self._release_time - (max_burst - 1) * interval
+        elif self._waiting:
+            next_time = self._waiting[0][0]
+        else:
+            next_time = None
+        if self._timer is not None and self._timer.active() and self._timer.getTime() != next_time:
+            self._timer.cancel()
+            self._timer = None
+        if next_time is not None and (self._timer is None or not self._timer.active()):
+            self._timer = reactor.callLater(max(next_time - now, 0), self._process)
+
+    @run_in_twisted_thread
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_CFGSettingsObjectDidChange(self, notification):
+        if {'sip.register_rate_limit', 'sip.register_burst'}.intersection(notification.data.modified):
+            self._process()
+
+    def _NH_NetworkConditionsDidChange(self, notification):
+        # the network conditions usually change several times in a row, so only react once they settle
+        if self._network_change_timer is not None and self._network_change_timer.active():
+            self._network_change_timer.reset(self.network_change_delay)
+        else:
+            self._network_change_timer = reactor.callLater(self.network_change_delay, self._reregister_all)
+
+    def _reregister_all(self):
+        self._network_change_timer = None
+        for registrar in self.registrars:
+            if registrar.active:
+                self.schedule(registrar, reregister=True)
+
+
 class Registrar(object):
     implements(IObserver)
 
@@ -53,7 +236,15 @@ class Registrar(object):
         self._registration = None
         self._dns_wait = 1
         self._register_wait = 1
-        self._registration_timer = None
+
+    @staticmethod
+    def get_lookup_uri(account):
+        """Return the SIP URI which is looked up in order to find the routes to the registrar of account"""
+        settings = SIPSimpleSettings()
+        if account.sip.outbound_proxy is not None and account.sip.outbound_proxy.transport in settings.sip.transport_list:
+            return SIPURI(host=account.sip.outbound_proxy.host, port=account.sip.outbound_proxy.port, parameters={'transport': account.sip.outbound_proxy.transport})
+        else:
+            return SIPURI(host=account.id.domain)
 
     def start(self):
         if self.started:
@@ -62,7 +253,7 @@ class Registrar(object):
         notification_center = NotificationCenter()
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange', sender=self.account)
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange', sender=SIPSimpleSettings())
-        notification_center.add_observer(self, name='NetworkConditionsDidChange')
+        RegistrationScheduler().add(self)
         self._command_proc = proc.spawn(self._run)
         if self.account.sip.register:
             self.activate()
@@ -75,7 +266,7 @@ class Registrar(object):
         notification_center = NotificationCenter()
         notification_center.remove_observer(self, name='CFGSettingsObjectDidChange', sender=self.account)
         notification_center.remove_observer(self, name='CFGSettingsObjectDidChange', sender=SIPSimpleSettings())
-        notification_center.remove_observer(self, name='NetworkConditionsDidChange')
+        RegistrationScheduler().remove(self)
         command = Command('terminate')
         self._command_channel.send(command)
         command.wait()
@@ -85,18 +276,25 @@ class Registrar(object):
         if not self.started:
             raise RuntimeError("not started")
         self.active = True
-        self._command_channel.send(Command('register'))
+        RegistrationScheduler().schedule(self)
 
     def deactivate(self):
         if not self.started:
             raise RuntimeError("not started")
         self.active = False
+        RegistrationScheduler().cancel(self)
         self._command_channel.send(Command('unregister'))
 
     def reregister(self):
         if self.active:
-            self._command_channel.send(Command('unregister'))
-            self._command_channel.send(Command('register'))
+            RegistrationScheduler().schedule(self, reregister=True)
+
+    def _start_registration(self, reregister, command):
+        # called by the RegistrationScheduler when it is time to send the REGISTER request
+        if self.active:
+            if reregister:
+                self._command_channel.send(Command('unregister'))
+            self._command_channel.send(command or Command('register'))
 
     def _run(self):
         while True:
@@ -108,10 +306,6 @@ class Registrar(object):
         notification_center = NotificationCenter()
         settings = SIPSimpleSettings()
 
-        if self._registration_timer is not None and self._registration_timer.active():
-            self._registration_timer.cancel()
-        self._registration_timer = None
-
         # Initialize the registration
         if self._registration is None:
             duration = command.refresh_interval or self.account.sip.register_interval
@@ -123,10 +317,7 @@ class Registrar(object):
 
         try:
             # Lookup routes
-            if self.account.sip.outbound_proxy is not None and self.account.sip.outbound_proxy.transport in settings.sip.transport_list:
-                uri = SIPURI(host=self.account.sip.outbound_proxy.host, port=self.account.sip.outbound_proxy.port, parameters={'transport': self.account.sip.outbound_proxy.transport})
-            else:
-                uri = SIPURI(host=self.account.id.domain)
+            uri = self.get_lookup_uri(self.account)
             lookup = DNSLookup()
             try:
                 routes = lookup.lookup_sip_proxy(uri, settings.sip.transport_list).wait()
@@ -203,6 +394,7 @@ class Registrar(object):
                                                              contact_header_list=notification.data.contact_header_list,
                                                              expires=notification.data.expires_in, registrar=route)
                         notification_center.post_notification('SIPAccountRegistrationDidSucceed', sender=self.account, data=notification_data)
+                        RegistrationScheduler().schedule_refresh(self, notification.data.expires_in)
                         self._register_wait = 1
                         command.signal()
                         break
@@ -215,20 +407,14 @@ class Registrar(object):
             self.registered = False
             notification_center.remove_observer(self, sender=self._registration)
             notification_center.post_notification('SIPAccountRegistrationDidFail', sender=self.account, data=NotificationData(error=e.error, retry_after=e.retry_after))
-            def register():
-                if self.active:
-                    self._command_channel.send(Command('register', command.event, refresh_interval=e.refresh_interval))
-                self._registration_timer = None
-            self._registration_timer = reactor.callLater(e.retry_after, register)
+            RegistrationScheduler().schedule(self, delay=e.retry_after, command=Command('register', command.event, refresh_interval=e.refresh_interval))
             self._registration = None
             self.account.contact.public_gruu = None
             self.account.contact.temporary_gruu = None
 
     def _CH_unregister(self, command):
-        # Cancel any timer which would restart the registration process
-        if self._registration_timer is not None and self._registration_timer.active():
-            self._registration_timer.cancel()
-        self._registration_timer = None
+        # Cancel any scheduled request which would restart the registration process
+        RegistrationScheduler().cancel(self)
         registered = self.registered
         self.registered = False
         if self._registration is not None:
@@ -278,7 +464,7 @@ class Registrar(object):
 
     def _NH_SIPRegistrationWillExpire(self, notification):
         if self.active:
-            self._command_channel.send(Command('register'))
+            RegistrationScheduler().schedule(self, priority=RegistrationScheduler.Expiring)
 
     @run_in_green_thread
     def _NH_CFGSettingsObjectDidChange(self, notification):
@@ -292,11 +478,5 @@ class Registrar(object):
             else:
                 self.deactivate()
         elif self.active and {'__id__', 'auth.password', 'auth.username', 'nat_traversal.use_ice', 'sip.outbound_proxy', 'sip.transport_list', 'sip.register_interval'}.intersection(notification.data.modified):
-            self._command_channel.send(Command('unregister'))
-            self._command_channel.send(Command('register'))
-
-    def _NH_NetworkConditionsDidChange(self, notification):
-        if self.active:
-            self._command_channel.send(Command('unregister'))
-            self._command_channel.send(Command('register'))
+            self.reregister()
 
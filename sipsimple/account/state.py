@@ -0,0 +1,75 @@
+
+"""Implements the merged views of the state reported by list subscriptions"""
+
+__all__ = ['MergedState']
+
+from threading import Lock
+
+
+class MergedState(object):
+    """
+    Merged view of the items reported by the notifications of a subscription
+    which can deliver either full or partial state (RLS and watcher-info).
+
+    A full state update replaces all the items, while a partial state update
+    only replaces the items it contains. Each update returns the keys of the
+    items that were added, removed or modified by it, so that only those need
+    to be reported. The items are kept when the subscription is reset, which
+    means that the first full state update of a new subscription will only
+    report what actually changed in the meantime.
+
+    Items are compared for equality, unless a comparison_key function is
+    given, in which case the values it returns for the items are compared.
+    The merged view can be queried like a read-only mapping.
+    """
+
+    def __init__(self, comparison_key=None):
+        self.comparison_key = comparison_key
+        self.version = None
+        self._items = {}
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        return self._items.get(key, default)
+
+    def snapshot(self):
+        """Return a dictionary with the current items"""
+        with self._lock:
+            return self._items.copy()
+
+    def reset(self):
+        with self._lock:
+            self.version = None
+
+    def update(self, version, full_state, items):
+        """
+        Apply the update with the specified version, given as an iterable of
+        (key, item) pairs, and return the set of keys that changed.
+        """
+        comparison_key = self.comparison_key or (lambda item: item)
+        with self._lock:
+            if full_state:
+                old_items, self._items = self._items, dict(items)
+                changed = set(key for key in old_items if key not in self._items)
+                changed.update(key for key, item in self._items.iteritems() if key not in old_items or comparison_key(old_items[key]) != comparison_key(item))
+            else:
+                changed = set()
+                for key, item in items:
+                    if key not in self._items or comparison_key(self._items[key]) != comparison_key(item):
+                        changed.add(key)
+                    self._items[key] = item
+            self.version = version
+            return changed
+
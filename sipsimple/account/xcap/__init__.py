@@ -92,7 +92,7 @@ class Document(object):
         try:
             document = StringIO(self.manager.storage.load(self.name))
             self.etag = document.readline().strip() or None
-            self.content = self.payload_type.parse(document)
+            self.content = self.payload_type.parse(document, trusted=True)
             self.__dict__['dirty'] = False
         except (XCAPStorageError, ParserError):
             self.etag = None
@@ -589,7 +589,7 @@ class OfflineStatus(object):
         return {'pidf': self.pidf.toxml()}
 
     def __setstate__(self, state):
-        self.pidf = pidf.PIDFDocument.parse(state['pidf'])
+        self.pidf = pidf.PIDFDocument.parse(state['pidf'], trusted=True)
 
 
 class Operation(object):
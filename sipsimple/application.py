@@ -303,6 +303,10 @@ class SIPApplication(object):
         self.engine.stop()
         self.engine.join(timeout=5)
 
+        # write any coalesced configuration changes before the file-io thread is stopped
+        configuration_manager = ConfigurationManager()
+        configuration_manager.flush()
+
         # stop threads
         thread_manager = ThreadManager()
         thread_manager.stop()
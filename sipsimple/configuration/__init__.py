@@ -9,7 +9,7 @@ __all__ = ['ConfigurationManager', 'ConfigurationError', 'ObjectNotFoundError',
 from abc import ABCMeta, abstractmethod
 from itertools import chain
 from operator import attrgetter
-from threading import Lock
+from threading import Lock, Timer
 from weakref import WeakSet
 
 from application import log
@@ -48,12 +48,25 @@ class ConfigurationManager(object):
     Singleton class used for storing and retrieving options, organized in
     sections. A section contains a list of objects, each with an assigned name
     which allows access to the object.
+
+    By default every call to save writes the data to the backend. If
+    flush_delay is set to a number of seconds, saves are coalesced instead:
+    the data is written once flush_delay seconds after the first pending save,
+    or as soon as flush_max_pending saves are pending if that is not None.
+    In this mode errors are not raised by save, but reported for the whole
+    batch by a CFGManagerSaveFailed notification with operation 'flush'.
     """
     __metaclass__ = Singleton
 
     def __init__(self):
         self.backend = None
         self.data = None
+        self.incremental = False
+        self.flush_delay = None
+        self.flush_max_pending = None
+        self._pending_saves = 0
+        self._flush_timer = None
+        self._flush_lock = Lock()
 
     def start(self):
         """
@@ -63,7 +76,7 @@ class ConfigurationManager(object):
         called.
         """
         from sipsimple.application import SIPApplication
-        from sipsimple.configuration.backend import IConfigurationBackend
+        from sipsimple.configuration.backend import IConfigurationBackend, IIncrementalConfigurationBackend
         if self.backend is not None:
             raise RuntimeError("ConfigurationManager already started")
         if SIPApplication.storage is None:
@@ -73,6 +86,7 @@ class ConfigurationManager(object):
             raise TypeError("SIPApplication.storage.configuration_backend must implement the IConfigurationBackend interface")
         self.data = backend.load()
         self.backend = backend
+        self.incremental = IIncrementalConfigurationBackend.providedBy(backend)
 
     def update(self, key, data):
         """
@@ -84,6 +98,8 @@ class ConfigurationManager(object):
         if not key:
             raise KeyError("key cannot be empty")
         self._update(self.data, list(key), data)
+        if self.incremental:
+            self._record_change(key)
 
     def rename(self, old_key, new_key):
         """
@@ -99,6 +115,9 @@ class ConfigurationManager(object):
         except KeyError:
             raise ObjectNotFoundError("object %s does not exist" % '/'.join(old_key))
         self._insert(self.data, list(new_key), data)
+        if self.incremental:
+            self._record_change(old_key)
+            self._record_change(new_key)
 
     def delete(self, key):
         """
@@ -113,6 +132,9 @@ class ConfigurationManager(object):
             self._pop(self.data, list(key))
         except KeyError:
             pass
+        else:
+            if self.incremental:
+                self._record_change(key)
 
     def get(self, key):
         """
@@ -146,11 +168,62 @@ class ConfigurationManager(object):
 
     def save(self):
         """
-        Flush the modified objects. Cannot be called before start().
+        Flush the modified objects, or schedule them to be flushed if saves
+        are coalesced. Cannot be called before start().
+        """
+        if self.backend is None:
+            raise RuntimeError("ConfigurationManager cannot be used unless started")
+        if self.flush_delay is None:
+            self.backend.save(self.data)
+            return
+        with self._flush_lock:
+            self._pending_saves += 1
+            flush_now = self.flush_max_pending is not None and self._pending_saves >= self.flush_max_pending
+            if not flush_now and self._flush_timer is None:
+                self._flush_timer = Timer(self.flush_delay, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        if flush_now:
+            self._flush()
+
+    @run_in_thread('file-io')
+    def flush(self):
+        """
+        Write the pending coalesced saves to the backend. As this runs in the
+        same thread as the save and delete methods of the settings objects, it
+        acts as a barrier: all the changes saved before calling flush are
+        written when it completes. Cannot be called before start().
         """
         if self.backend is None:
             raise RuntimeError("ConfigurationManager cannot be used unless started")
-        self.backend.save(self.data)
+        self._flush()
+
+    def _flush(self):
+        with self._flush_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            pending_saves, self._pending_saves = self._pending_saves, 0
+        if not pending_saves:
+            return
+        try:
+            self.backend.save(self.data)
+        except Exception, e:
+            log.err()
+            notification_center = NotificationCenter()
+            notification_center.post_notification('CFGManagerSaveFailed', sender=self, data=NotificationData(object=None, operation='flush', modified=None, exception=e, pending_saves=pending_saves))
+
+    def _record_change(self, key):
+        # Tell the backend about the resulting state of the subtree identified by key. If the subtree
+        # no longer exists, the record refers to the topmost container which was removed along with it.
+        data = self.data
+        for index, name in enumerate(key):
+            try:
+                data = data[name]
+            except KeyError:
+                self.backend.delete(list(key[:index+1]))
+                return
+        self.backend.update(list(key), data)
 
     def _get(self, data_tree, key):
         subtree_key = key.pop(0)
@@ -1,7 +1,7 @@
 
 """Base definitions for concrete implementations of configuration backends"""
 
-__all__ = ['ConfigurationBackendError', 'IConfigurationBackend']
+__all__ = ['ConfigurationBackendError', 'IConfigurationBackend', 'IIncrementalConfigurationBackend']
 
 
 from zope.interface import Interface
@@ -35,3 +35,23 @@ class IConfigurationBackend(Interface):
         """
 
 
+class IIncrementalConfigurationBackend(IConfigurationBackend):
+    """
+    Interface describing a configuration backend which is informed about each
+    individual change made to the configuration data, so that it can store
+    only the changes instead of the whole data when save is called.
+
+    A key is a list of unicode strings identifying a subtree of the data.
+    """
+    def update(key, data):
+        """
+        Record that the subtree identified by key now contains data, which is
+        a dictionary conforming to the definition in IConfigurationBackend.
+        """
+
+    def delete(key):
+        """
+        Record that the subtree identified by key was removed.
+        """
+
+
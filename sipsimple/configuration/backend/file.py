@@ -4,6 +4,8 @@
 __all__ = ["FileParserError", "FileBuilderError", "FileBackend"]
 
 import errno
+import hashlib
+import marshal
 import os
 import re
 import platform
@@ -55,15 +57,31 @@ class FileBackend(object):
 
     escape_characters_re = re.compile(ur"""[,"'=: #\\\t\x0b\x0c\n\r]""")
 
-    def __init__(self, filename, encoding='utf-8'):
+    simple_line_re = re.compile(ur"""(\s*)([^\s'"\\#:=]+)\s*(?:(:)|(=)\s*([^\s'"\\#,]*))$""", re.UNICODE)
+    whitespace_re = re.compile(ur"\s*", re.UNICODE)
+    trailing_backslash_re = re.compile(ur"(?:[^\\]|\\.)*\\$", re.UNICODE | re.DOTALL)
+    name_token_re = re.compile(ur"""(?:[^\s'"\\#:=]+|"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|\\.)*""", re.UNICODE | re.DOTALL)
+    value_token_re = re.compile(ur"""(?:[^\s'"\\#,]+|"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|\\.)*""", re.UNICODE | re.DOTALL)
+    token_part_re = re.compile(ur"""(?P<quoted>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|\\(?P<escaped>.)""", re.UNICODE | re.DOTALL)
+    escape_re = re.compile(ur"\\(.)", re.UNICODE | re.DOTALL)
+    escape_sequences = {u'n': u'\n', u'r': u'\r'}
+
+    cache_version = 1
+
+    def __init__(self, filename, encoding='utf-8', cache=False):
         """
         Initialize the configuration backend with the specified file.
 
         The file is not read at this time, but rather each time the load method
         is called.
+
+        If cache is True, the parsed data is also kept in a binary file next
+        to the configuration file, which is used instead of parsing the
+        configuration file as long as the latter is not modified.
         """
         self.filename = filename
         self.encoding = encoding
+        self.cache_filename = filename + '.cache' if cache else None
 
     def load(self):
         """
@@ -72,16 +90,29 @@ class FileBackend(object):
         """
 
         try:
-            file = open(self.filename)
+            with open(self.filename, 'rb') as file:
+                content = file.read()
+                file_stat = os.fstat(file.fileno())
         except IOError, e:
             if e.errno == errno.ENOENT:
                 return {}
             else:
                 raise ConfigurationBackendError("failed to read configuration file: %s" % str(e))
 
+        if self.cache_filename is None:
+            return self._parse(content)
+
+        digest = hashlib.sha1(content).digest()
+        data = self._load_cache(file_stat, digest)
+        if data is None:
+            data = self._parse(content)
+            self._save_cache(file_stat, digest, data)
+        return data
+
+    def _parse(self, content):
         state_stack = deque()
         state_stack.appendleft(GroupState(-1))
-        for lineno, line in enumerate(file, 1):
+        for lineno, line in enumerate(content.split('\n'), 1):
             line = self._parse_line(line, lineno)
             if not line.name:
                 continue
@@ -109,86 +140,95 @@ class FileBackend(object):
         try:
             if config_directory:
                 makedirs(config_directory)
+            content = (os.linesep.join(lines)+os.linesep).encode(self.encoding)
             file = openfile(tmp_filename, 'wb', permissions=0600)
-            file.write((os.linesep.join(lines)+os.linesep).encode(self.encoding))
+            file.write(content)
             file.close()
             if platform.system() == 'Windows':
                 # os.rename does not work on Windows if the destination file already exists.
                 # It seems there is no atomic way to do this on Windows.
                 unlink(self.filename)
             os.rename(tmp_filename, self.filename)
+            file_stat = os.stat(self.filename)
         except (IOError, OSError), e:
             raise ConfigurationBackendError("failed to write configuration file: %s" % str(e))
+        if self.cache_filename is not None:
+            self._save_cache(file_stat, hashlib.sha1(content).digest(), self._copy_group(data))
 
-    def _parse_line(self, line, lineno):
-        def advance_to_next_token(line):
-            counter = 0
-            while line and line[0].isspace():
-                line.popleft()
-                counter += 1
-            if line and line[0] == u'#':
-                line.clear()
-            return counter
-        def token_iterator(line, delimiter=''):
-            quote_char = None
-            while line:
-                if quote_char is None and line[0] in delimiter:
-                    break
-                char = line.popleft()
-                if char in u"'\"":
-                    if quote_char is None:
-                        quote_char = char
-                        continue
-                    elif quote_char == char:
-                        quote_char = None
-                        continue
-                    else:
-                        yield char
-                elif char == u'\\':
-                    if not line:
-                        raise FileParserError("unexpected `\\' at end of line %d" % lineno)
-                    char = line.popleft()
-                    if char == 'n':
-                        yield u'\n'
-                    elif char == 'r':
-                        yield u'\r'
-                    else:
-                        yield char
-                elif quote_char is None and char == u'#':
-                    line.clear()
-                    break
-                elif quote_char is None and char.isspace():
-                    break
-                else:
-                    yield char
-            if quote_char is not None:
-                raise FileParserError("missing ending quote at line %d" % lineno)
+    def _load_cache(self, file_stat, digest):
+        try:
+            with open(self.cache_filename, 'rb') as file:
+                version, encoding, size, mtime, cached_digest, data = marshal.load(file)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if (version, encoding, size, mtime, cached_digest) != (self.cache_version, self.encoding, file_stat.st_size, file_stat.st_mtime, digest):
+            return None
+        return data
 
-        line = deque(line.rstrip().decode(self.encoding))
-        indentation = advance_to_next_token(line)
+    def _save_cache(self, file_stat, digest, data):
+        # the cache is only an optimization, so failing to write it is not an error
+        tmp_filename = '%s.%d.%08X' % (self.cache_filename, os.getpid(), random.getrandbits(32))
+        try:
+            file = openfile(tmp_filename, 'wb', permissions=0600)
+            marshal.dump((self.cache_version, self.encoding, file_stat.st_size, file_stat.st_mtime, digest, data), file)
+            file.close()
+            if platform.system() == 'Windows':
+                unlink(self.cache_filename)
+            os.rename(tmp_filename, self.cache_filename)
+        except (IOError, OSError, ValueError):
+            unlink(tmp_filename)
+
+    def _copy_group(self, group):
+        # marshal does not handle subclasses of the builtin types (like PersistentKey) correctly
+        copy = {}
+        for name, data in group.iteritems():
+            if type(data) is dict:
+                data = self._copy_group(data)
+            elif type(data) is list:
+                # an empty list is saved as an empty value, which is loaded as None
+                data = [unicode(item) for item in data] or None
+            elif data is not None:
+                data = unicode(data)
+            copy[unicode(name)] = data
+        return copy
+
+    def _parse_line(self, line, lineno):
+        line = line.rstrip().decode(self.encoding)
         if not line:
+            return Line(0, None, None, None)
+        match = self.simple_line_re.match(line)
+        if match is not None:
+            # fast path for lines without quoting, escaping, comments or lists
+            indentation, name, group_separator, setting_separator, value = match.groups()
+            if group_separator is not None:
+                return Line(len(indentation), name, group_separator, None)
+            return Line(len(indentation), name, setting_separator, value or None)
+        position = self.whitespace_re.match(line).end()
+        indentation = position
+        if position == len(line) or line[position] == u'#':
             return Line(indentation, None, None, None)
-        name = u''.join(token_iterator(line, delimiter=u':='))
-        advance_to_next_token(line)
-        if not line or line[0] not in u':=':
+        match = self.name_token_re.match(line, position)
+        name = self._unquote(match.group())
+        position = self._skip_whitespace(line, self._check_token_end(line, match.end(), lineno))
+        if position == len(line) or line[position] not in u':=':
             raise FileParserError("expected one of `:' or `=' at line %d" % lineno)
         if not name:
             raise FileParserError("missing setting/section name at line %d" % lineno)
-        separator = line.popleft()
-        advance_to_next_token(line)
-        if not line:
+        separator = line[position]
+        position = self._skip_whitespace(line, position+1)
+        if position == len(line):
             return Line(indentation, name, separator, None)
         elif separator == u':':
             raise FileParserError("unexpected characters after `:' at line %d" % lineno)
         value = None
         value_list = None
-        while line:
-            value = u''.join(token_iterator(line, delimiter=u','))
-            advance_to_next_token(line)
-            if line:
-                if line[0] == u',':
-                    line.popleft()
-                    advance_to_next_token(line)
+        while position < len(line):
+            match = self.value_token_re.match(line, position)
+            value = self._unquote(match.group())
+            position = self._skip_whitespace(line, self._check_token_end(line, match.end(), lineno))
+            if position < len(line):
+                if line[position] == u',':
+                    position = self._skip_whitespace(line, position+1)
                     if value_list is None:
                         value_list = []
                 else:
@@ -198,6 +238,41 @@ class FileBackend(object):
         value = value_list if value_list is not None else value
         return Line(indentation, name, separator, value)
 
+    def _skip_whitespace(self, line, position):
+        # returns the position of the next token, or the end of the line if only a comment follows
+        position = self.whitespace_re.match(line, position).end()
+        if position < len(line) and line[position] == u'#':
+            return len(line)
+        return position
+
+    def _check_token_end(self, line, position, lineno):
+        # returns the position after the token delimiter, or raises an error if the token was left unfinished
+        if position == len(line):
+            return position
+        char = line[position]
+        if char == u'\\':
+            raise FileParserError("unexpected `\\' at end of line %d" % lineno)
+        elif char in u'\'"':
+            if self.trailing_backslash_re.match(line, position+1):
+                raise FileParserError("unexpected `\\' at end of line %d" % lineno)
+            raise FileParserError("missing ending quote at line %d" % lineno)
+        elif char == u'#':
+            return len(line)
+        elif char.isspace():
+            return position + 1
+        return position
+
+    def _unquote(self, token):
+        if u'\\' not in token and u'"' not in token and u"'" not in token:
+            return token
+        return self.token_part_re.sub(self._unquote_part, token)
+
+    def _unquote_part(self, match):
+        escaped_char = match.group('escaped')
+        if escaped_char is not None:
+            return self.escape_sequences.get(escaped_char, escaped_char)
+        return self.escape_re.sub(lambda match: self.escape_sequences.get(match.group(1), match.group(1)), match.group('quoted')[1:-1])
+
     def _build_group(self, group, indentation):
         setting_lines = []
         group_lines = []
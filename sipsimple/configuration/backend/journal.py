@@ -0,0 +1,216 @@
+
+"""Configuration backend for storing settings in an append-only journal"""
+
+__all__ = ["JournalParserError", "JournalBackend"]
+
+import errno
+import json
+import os
+import shutil
+import time
+
+from copy import deepcopy
+from threading import Lock
+
+from application import log
+from application.system import makedirs, openfile, unlink
+from zope.interface import implements
+
+from sipsimple.configuration.backend import IIncrementalConfigurationBackend, ConfigurationBackendError
+from sipsimple.configuration.backend.file import FileBackend
+from sipsimple.threading import call_in_thread
+
+
+class JournalParserError(ConfigurationBackendError):
+    """Error raised when the configuration journal cannot be parsed."""
+
+
+class JournalBackend(object):
+    """
+    Implementation of a configuration backend that keeps a snapshot of the
+    configuration in the plain text format used by FileBackend and appends
+    every subsequent change to a journal file.
+
+    Each journal record describes the complete state of the subtree it refers
+    to after the change was applied, which makes records idempotent: replaying
+    a journal over a snapshot that already includes some of its changes yields
+    the same data. When the journal grows beyond compaction_size bytes or when
+    it is older than compaction_interval seconds, the snapshot is rewritten in
+    the background and the journal is discarded.
+    """
+
+    implements(IIncrementalConfigurationBackend)
+
+    def __init__(self, filename, encoding='utf-8', cache=False, compaction_size=1024*1024, compaction_interval=3600):
+        """
+        Initialize the configuration backend with the specified file. The
+        journal is kept in a file with the same name and a .journal suffix.
+
+        The files are not read at this time, but rather each time the load
+        method is called. The cache argument is passed to the FileBackend
+        which handles the snapshot.
+        """
+        self.filename = filename
+        self.encoding = encoding
+        self.compaction_size = compaction_size
+        self.compaction_interval = compaction_interval
+        self.journal_filename = filename + '.journal'
+        self.old_journal_filename = filename + '.journal.old'
+        self.snapshot = FileBackend(filename, encoding, cache=cache)
+        self.records = []
+        self.lock = Lock()
+        self._journal = None
+        self._journal_size = 0
+        self._journal_start = None
+        self._compacting = False
+
+    def load(self):
+        """
+        Read the snapshot and replay the journal over it, returning a
+        dictionary conforming to the IConfigurationBackend specification.
+        """
+        data = self.snapshot.load()
+        replayed_old_journal = self._replay(self.old_journal_filename, data)
+        self._replay(self.journal_filename, data)
+        try:
+            self._journal_size = os.path.getsize(self.journal_filename)
+        except OSError:
+            self._journal_size = 0
+        self._journal_start = time.time() if self._journal_size else None
+        if replayed_old_journal:
+            # a compaction was interrupted, finish it before appending anything else
+            self.snapshot.save(data)
+            self._unlink(self.old_journal_filename)
+        return data
+
+    def update(self, key, data):
+        """Record that the subtree identified by key now contains data."""
+        self._add_record([u'set', key, data])
+
+    def delete(self, key):
+        """Record that the subtree identified by key was removed."""
+        self._add_record([u'del', key])
+
+    def save(self, data):
+        """
+        Append the changes recorded since the last call to the journal and, if
+        the journal reached one of the compaction thresholds, start rewriting
+        the snapshot in the background using the given data.
+        """
+        with self.lock:
+            records, self.records = self.records, []
+        if records:
+            try:
+                if self._journal is None:
+                    config_directory = os.path.dirname(self.journal_filename)
+                    if config_directory:
+                        makedirs(config_directory)
+                    self._journal = openfile(self.journal_filename, 'ab', permissions=0600)
+                self._journal.write(''.join(records))
+                self._journal.flush()
+            except (IOError, OSError), e:
+                raise ConfigurationBackendError("failed to write configuration journal: %s" % str(e))
+            self._journal_size += sum(len(record) for record in records)
+            if self._journal_start is None:
+                self._journal_start = time.time()
+        if not self._compacting and self._journal_size and (self._journal_size >= self.compaction_size or time.time() - self._journal_start >= self.compaction_interval):
+            self._start_compaction(data)
+
+    def _add_record(self, record):
+        record = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.records.append(record)
+
+    def _start_compaction(self, data):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        try:
+            if os.path.exists(self.old_journal_filename):
+                # a previous compaction failed, the old journal still holds records which are not in the snapshot
+                with open(self.journal_filename, 'rb') as journal, open(self.old_journal_filename, 'ab') as old_journal:
+                    shutil.copyfileobj(journal, old_journal)
+                unlink(self.journal_filename)
+            else:
+                os.rename(self.journal_filename, self.old_journal_filename)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                raise ConfigurationBackendError("failed to rotate configuration journal: %s" % str(e))
+        self._journal_size = 0
+        self._journal_start = None
+        self._compacting = True
+        call_in_thread('config-compaction', self._compact, deepcopy(data))
+
+    def _compact(self, data):
+        try:
+            self.snapshot.save(data)
+            self._unlink(self.old_journal_filename)
+        except ConfigurationBackendError:
+            # the old journal is left in place and will be replayed on the next load
+            log.err()
+        finally:
+            self._compacting = False
+
+    def _replay(self, filename, data):
+        try:
+            file = open(filename, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise ConfigurationBackendError("failed to read configuration journal: %s" % str(e))
+        offset = 0
+        with file:
+            for lineno, line in enumerate(file, 1):
+                try:
+                    record = json.loads(line)
+                    operation, key = record[0], record[1]
+                except (ValueError, IndexError, TypeError):
+                    if not line.endswith('\n'):
+                        # the last write was interrupted, drop the partial record so that new ones are appended after a complete line
+                        log.warning("Ignoring incomplete record at the end of configuration journal %s" % filename)
+                        self._truncate(filename, offset)
+                        break
+                    raise JournalParserError("invalid record at line %d of %s" % (lineno, filename))
+                offset += len(line)
+                if operation == u'set':
+                    self._set(data, key, record[2])
+                elif operation == u'del':
+                    self._delete(data, key)
+                else:
+                    raise JournalParserError("unknown operation %r at line %d of %s" % (operation, lineno, filename))
+        return True
+
+    @staticmethod
+    def _set(data, key, value):
+        for name in key[:-1]:
+            subtree = data.get(name)
+            if type(subtree) is not dict:
+                subtree = data[name] = {}
+            data = subtree
+        data[key[-1]] = value
+
+    @staticmethod
+    def _delete(data, key):
+        for name in key[:-1]:
+            data = data.get(name)
+            if type(data) is not dict:
+                return
+        data.pop(key[-1], None)
+
+    @staticmethod
+    def _truncate(filename, size):
+        try:
+            with open(filename, 'r+b') as file:
+                file.truncate(size)
+        except (IOError, OSError), e:
+            raise ConfigurationBackendError("failed to truncate %s: %s" % (filename, str(e)))
+
+    @staticmethod
+    def _unlink(filename):
+        try:
+            os.unlink(filename)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise ConfigurationBackendError("failed to remove %s: %s" % (filename, str(e)))
+
+
@@ -7,7 +7,7 @@ Definition of general (non-account related) settings.
 
 from sipsimple import __version__
 from sipsimple.configuration import CorrelatedSetting, RuntimeSetting, Setting, SettingsGroup, SettingsObject
-from sipsimple.configuration.datatypes import NonNegativeInteger, PJSIPLogLevel
+from sipsimple.configuration.datatypes import NonNegativeInteger, PositiveInteger, PJSIPLogLevel
 from sipsimple.configuration.datatypes import AudioCodecList, SampleRate, VideoCodecList
 from sipsimple.configuration.datatypes import Port, PortRange, SIPTransportList
 from sipsimple.configuration.datatypes import Path
@@ -56,6 +56,12 @@ class ScreenSharingSettings(SettingsGroup):
 
 class FileTransferSettings(SettingsGroup):
     directory = Setting(type=Path, default=Path('~/Downloads'))
+    chunk_size = Setting(type=PositiveInteger, default=64*1024)
+    send_window = Setting(type=PositiveInteger, default=16)
+    precompute_hash = Setting(type=bool, default=True)
+    progress_interval = Setting(type=float, default=0.5, nillable=True)
+    progress_step = Setting(type=PositiveInteger, default=None, nillable=True)
+    progress_bytes = Setting(type=PositiveInteger, default=None, nillable=True)
 
 
 class LogsSettings(SettingsGroup):
@@ -82,6 +88,8 @@ class SIPSettings(SettingsGroup):
     tcp_port = CorrelatedSetting(type=Port, sibling='tls_port', validator=sip_port_validator, default=0)
     tls_port = CorrelatedSetting(type=Port, sibling='tcp_port', validator=sip_port_validator, default=0)
     transport_list = Setting(type=SIPTransportList, default=SIPTransportList(('tls', 'tcp', 'udp')))
+    register_rate_limit = Setting(type=PositiveInteger, default=None, nillable=True)
+    register_burst = Setting(type=PositiveInteger, default=20)
 
 
 class TLSSettings(SettingsGroup):
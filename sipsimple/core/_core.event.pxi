@@ -76,7 +76,7 @@ cdef int _event_queue_append(_core_event *event):
         pj_mutex_unlock(_event_queue_lock)
     return 0
 
-cdef list _get_clear_event_queue():
+cdef list _get_clear_event_queue(int include_log):
     global _re_log, _event_queue_head, _event_queue_tail, _event_queue_lock
     cdef object events = []
     cdef _core_event *event
@@ -95,9 +95,11 @@ cdef list _get_clear_event_queue():
         pj_mutex_unlock(_event_queue_lock)
     while event != NULL:
         if event.is_log:
-            log_msg = PyString_FromStringAndSize(<char *> event.data, event.len)
-            event_params = dict(level=event.level, message=log_msg)
-            events.append(("SIPEngineLog", event_params))
+            if include_log:
+                log_msg = PyString_FromStringAndSize(<char *> event.data, event.len)
+                event_params = dict(level=event.level, message=log_msg)
+                events.append(("SIPEngineLog", event_params))
+            free(event.data)
         else:
             event_tup = <object> event.data
             Py_DECREF(event_tup)
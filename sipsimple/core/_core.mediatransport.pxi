@@ -1059,6 +1059,36 @@ cdef class AudioTransport:
             self._pool = NULL
             return None
 
+    cdef int _get_stat(self, pjmedia_rtcp_stat *stat) except -1:
+        # fills in the statistics and returns 1, or returns 0 if the stream is not active; the lock is only held while copying them
+        cdef int status
+        cdef pj_mutex_t *lock = self._lock
+        cdef pjmedia_stream *stream
+        cdef PJSIPUA ua
+
+        ua = self._check_ua()
+        if ua is None:
+            return 0
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            stream = self._obj
+
+            if stream == NULL:
+                return 0
+
+            with nogil:
+                status = pjmedia_stream_get_stat(stream, stat)
+            if status != 0:
+                raise PJSIPError("Could not get RTP statistics", status)
+            return 1
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
     property is_active:
 
         def __get__(self):
@@ -1096,38 +1126,24 @@ cdef class AudioTransport:
     property statistics:
 
         def __get__(self):
-            cdef int status
-            cdef pj_mutex_t *lock = self._lock
             cdef pjmedia_rtcp_stat stat
-            cdef pjmedia_stream *stream
             cdef dict statistics = dict()
-            cdef PJSIPUA ua
 
-            ua = self._check_ua()
-            if ua is None:
+            if self._get_stat(&stat) == 0:
                 return None
+            statistics["rtt"] = _pj_math_stat_to_dict(&stat.rtt)
+            statistics["rx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.rx)
+            statistics["tx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.tx)
+            return statistics
 
-            with nogil:
-                status = pj_mutex_lock(lock)
-            if status != 0:
-                raise PJSIPError("failed to acquire lock", status)
-            try:
-                stream = self._obj
+    property statistics_sample:
 
-                if stream == NULL:
-                    return None
+        def __get__(self):
+            cdef pjmedia_rtcp_stat stat
 
-                with nogil:
-                    status = pjmedia_stream_get_stat(stream, &stat)
-                if status != 0:
-                    raise PJSIPError("Could not get RTP statistics", status)
-                statistics["rtt"] = _pj_math_stat_to_dict(&stat.rtt)
-                statistics["rx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.rx)
-                statistics["tx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.tx)
-                return statistics
-            finally:
-                with nogil:
-                    pj_mutex_unlock(lock)
+            if self._get_stat(&stat) == 0:
+                return None
+            return _pjmedia_rtcp_stat_to_tuple(&stat)
 
     property volume:
 
@@ -1579,6 +1595,36 @@ cdef class VideoTransport:
             self._pool = NULL
             return None
 
+    cdef int _get_stat(self, pjmedia_rtcp_stat *stat) except -1:
+        # fills in the statistics and returns 1, or returns 0 if the stream is not active; the lock is only held while copying them
+        cdef int status
+        cdef pj_mutex_t *lock = self._lock
+        cdef pjmedia_vid_stream *stream
+        cdef PJSIPUA ua
+
+        ua = self._check_ua()
+        if ua is None:
+            return 0
+
+        with nogil:
+            status = pj_mutex_lock(lock)
+        if status != 0:
+            raise PJSIPError("failed to acquire lock", status)
+        try:
+            stream = self._obj
+
+            if stream == NULL:
+                return 0
+
+            with nogil:
+                status = pjmedia_vid_stream_get_stat(stream, stat)
+            if status != 0:
+                raise PJSIPError("Could not get RTP statistics", status)
+            return 1
+        finally:
+            with nogil:
+                pj_mutex_unlock(lock)
+
     property is_active:
 
         def __get__(self):
@@ -1611,38 +1657,24 @@ cdef class VideoTransport:
     property statistics:
 
         def __get__(self):
-            cdef int status
-            cdef pj_mutex_t *lock = self._lock
             cdef pjmedia_rtcp_stat stat
-            cdef pjmedia_vid_stream *stream
             cdef dict statistics = dict()
-            cdef PJSIPUA ua
 
-            ua = self._check_ua()
-            if ua is None:
+            if self._get_stat(&stat) == 0:
                 return None
+            statistics["rtt"] = _pj_math_stat_to_dict(&stat.rtt)
+            statistics["rx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.rx)
+            statistics["tx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.tx)
+            return statistics
 
-            with nogil:
-                status = pj_mutex_lock(lock)
-            if status != 0:
-                raise PJSIPError("failed to acquire lock", status)
-            try:
-                stream = self._obj
+    property statistics_sample:
 
-                if stream == NULL:
-                    return None
+        def __get__(self):
+            cdef pjmedia_rtcp_stat stat
 
-                with nogil:
-                    status = pjmedia_vid_stream_get_stat(stream, &stat)
-                if status != 0:
-                    raise PJSIPError("Could not get RTP statistics", status)
-                statistics["rtt"] = _pj_math_stat_to_dict(&stat.rtt)
-                statistics["rx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.rx)
-                statistics["tx"] = _pjmedia_rtcp_stream_stat_to_dict(&stat.tx)
-                return statistics
-            finally:
-                with nogil:
-                    pj_mutex_unlock(lock)
+            if self._get_stat(&stat) == 0:
+                return None
+            return _pjmedia_rtcp_stat_to_tuple(&stat)
 
     def get_local_media(self, BaseSDPSession remote_sdp=None, int index=0, direction="sendrecv"):
         global valid_sdp_directions
@@ -2123,6 +2155,10 @@ cdef dict _pjmedia_rtcp_stream_stat_to_dict(pjmedia_rtcp_stream_stat *stream_sta
     retval["jitter"] = _pj_math_stat_to_dict(&stream_stat.jitter)
     return retval
 
+cdef tuple _pjmedia_rtcp_stat_to_tuple(pjmedia_rtcp_stat *stat):
+    # the order of the fields is described by sipsimple.streams.rtp.statistics.RTPStatisticsHistory.fields
+    return (stat.rtt.last, stat.rx.pkt, stat.rx.bytes, stat.rx.loss, stat.rx.discard, stat.rx.jitter.last, stat.tx.pkt, stat.tx.bytes, stat.tx.loss, stat.tx.jitter.last)
+
 cdef str _ice_state_to_str(int state):
     if state == PJ_ICE_STRANS_STATE_NULL:
         return 'NULL'
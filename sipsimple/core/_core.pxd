@@ -1115,6 +1115,7 @@ cdef extern from "pjsip.h":
     pj_pool_t *pjsip_endpt_create_pool(pjsip_endpoint *endpt, char *pool_name, int initial, int increment) nogil
     void pjsip_endpt_release_pool(pjsip_endpoint *endpt, pj_pool_t *pool) nogil
     int pjsip_endpt_handle_events(pjsip_endpoint *endpt, pj_time_val *max_timeout) nogil
+    int pjsip_endpt_handle_events2(pjsip_endpoint *endpt, pj_time_val *max_timeout, unsigned int *count) nogil
     int pjsip_endpt_register_module(pjsip_endpoint *endpt, pjsip_module *module) nogil
     int pjsip_endpt_schedule_timer(pjsip_endpoint *endpt, pj_timer_entry *entry, pj_time_val *delay) nogil
     void pjsip_endpt_cancel_timer(pjsip_endpoint *endpt, pj_timer_entry *entry) nogil
@@ -1797,6 +1798,8 @@ cdef class Timer(object):
     cdef double schedule_time
     cdef timer_callback callback
     cdef object obj
+    cdef list _heap_entry
+    cdef unsigned long long _sequence
 
     # private methods
     cdef int schedule(self, float delay, timer_callback callback, object obj) except -1
@@ -1812,7 +1815,19 @@ cdef class PJSIPUA(object):
     # attributes
     cdef object _threads
     cdef object _event_handler
+    cdef object _event_filter
     cdef list _timers
+    cdef int _cancelled_timers
+    cdef unsigned long long _timer_sequence
+    cdef int _poll_batch_size
+    cdef double _max_poll_timeout
+    cdef unsigned long long _poll_iterations
+    cdef unsigned long long _poll_events
+    cdef double _poll_event_time
+    cdef double _poll_handler_time
+    cdef unsigned int _last_poll_events
+    cdef double _last_poll_event_time
+    cdef double _last_poll_handler_time
     cdef PJLIB _pjlib
     cdef PJCachingPool _caching_pool
     cdef PJSIPEndpoint _pjsip_endpoint
@@ -1853,6 +1868,7 @@ cdef class PJSIPUA(object):
     cdef object _get_default_sound_device(self, int is_output)
     cdef object _get_video_devices(self)
     cdef object _get_default_video_device(self)
+    cdef int _has_observers(self, object event_name) except -1
     cdef int _poll_log(self) except -1
     cdef int _handle_exception(self, int is_fatal) except -1
     cdef int _check_self(self) except -1
@@ -2039,7 +2055,7 @@ cdef struct _handler_queue
 cdef int _event_queue_append(_core_event *event)
 cdef void _cb_log(int level, char_ptr_const data, int len)
 cdef int _add_event(object event_name, dict params) except -1
-cdef list _get_clear_event_queue()
+cdef list _get_clear_event_queue(int include_log)
 cdef int _add_handler(int func(object obj) except -1, object obj, _handler_queue *queue) except -1
 cdef int _remove_handler(object obj, _handler_queue *queue) except -1
 cdef int _process_handler_queue(PJSIPUA ua, _handler_queue *queue) except -1
@@ -2588,6 +2604,7 @@ cdef class AudioTransport(object):
 
     # private methods
     cdef PJSIPUA _check_ua(self)
+    cdef int _get_stat(self, pjmedia_rtcp_stat *stat) except -1
     cdef int _cb_check_rtp(self, MediaCheckTimer timer) except -1 with gil
 
 cdef class VideoTransport(object):
@@ -2610,6 +2627,7 @@ cdef class VideoTransport(object):
 
     # private methods
     cdef PJSIPUA _check_ua(self)
+    cdef int _get_stat(self, pjmedia_rtcp_stat *stat) except -1
     cdef int _cb_check_rtp(self, MediaCheckTimer timer) except -1 with gil
 
 cdef void _RTPTransport_cb_ice_complete(pjmedia_transport *tp, pj_ice_strans_op op, int status) with gil
@@ -2632,3 +2650,4 @@ cdef dict _extract_ice_session_data(pj_ice_sess *ice_sess)
 cdef object _extract_rtp_transport(pjmedia_transport *tp)
 cdef dict _pj_math_stat_to_dict(pj_math_stat *stat)
 cdef dict _pjmedia_rtcp_stream_stat_to_dict(pjmedia_rtcp_stream_stat *stream_stat)
+cdef tuple _pjmedia_rtcp_stat_to_tuple(pjmedia_rtcp_stat *stat)
@@ -36,27 +36,9 @@ cdef class Timer:
 
     cdef int call(self) except -1:
         self._scheduled = 0
+        self._heap_entry = None
         self.callback(self.obj, self)
 
-    def __richcmp__(self, other, op):
-        cdef double diff
-        if not isinstance(self, Timer) or not isinstance(other, Timer):
-            return NotImplemented
-        diff = (<Timer>self).schedule_time - (<Timer>other).schedule_time
-        if op == 0: # <
-            return diff < 0.0
-        elif op == 1: # <=
-            return diff <= 0.0
-        elif op == 2: # ==
-            return diff == 0.0
-        elif op == 3: # !=
-            return diff != 0.0
-        elif op == 4: # >
-            return diff > 0.0
-        elif op == 5: # >=
-            return diff >= 0.0
-        return
-
 
 cdef class PJSIPUA:
     def __cinit__(self, *args, **kwargs):
@@ -66,6 +48,8 @@ cdef class PJSIPUA:
         _ua = <void *> self
         self._threads = []
         self._timers = list()
+        self._cancelled_timers = 0
+        self._timer_sequence = 0
         self._events = {}
         self._incoming_events = set()
         self._incoming_requests = set()
@@ -82,6 +66,7 @@ cdef class PJSIPUA:
         cdef PJSTR str_norefersub = PJSTR("norefersub")
         cdef PJSTR str_gruu = PJSTR("gruu")
         self._event_handler = event_handler
+        self._event_filter = kwargs.get("event_filter", None)
         if kwargs["log_level"] < 0 or kwargs["log_level"] > PJ_LOG_MAX_LEVEL:
             raise ValueError("Log level should be between 0 and %d" % PJ_LOG_MAX_LEVEL)
         pj_log_set_level(kwargs["log_level"])
@@ -191,6 +176,8 @@ cdef class PJSIPUA:
             self._incoming_requests.add(method)
         self.rtp_port_range = kwargs["rtp_port_range"]
         self.zrtp_cache = kwargs["zrtp_cache"]
+        self.poll_batch_size = kwargs["poll_batch_size"]
+        self.max_poll_timeout = kwargs["max_poll_timeout"]
         pj_stun_config_init(&self._stun_cfg, &self._caching_pool._obj.factory, 0,
                             pjmedia_endpt_get_ioqueue(self._pjmedia_endpoint._obj),
                             pjsip_endpt_get_timer_heap(self._pjsip_endpoint._obj))
@@ -238,6 +225,58 @@ cdef class PJSIPUA:
             self._check_self()
             return self._ip_address
 
+    property poll_batch_size:
+
+        def __get__(self):
+            self._check_self()
+            return self._poll_batch_size
+
+        def __set__(self, value):
+            self._check_self()
+            if value < 1:
+                raise ValueError("poll_batch_size must be at least 1")
+            self._poll_batch_size = value
+
+    property max_poll_timeout:
+
+        def __get__(self):
+            self._check_self()
+            return self._max_poll_timeout
+
+        def __set__(self, value):
+            self._check_self()
+            if value < 0:
+                raise ValueError("max_poll_timeout must be a non-negative number")
+            self._max_poll_timeout = value
+
+    property poll_statistics:
+
+        # event_time is the time spent in pjsip_endpt_handle_events2, which includes waiting for the events, handling
+        # them in pjsip and running the callbacks into Python which they trigger. handler_time is the time spent after
+        # that, running the post poll handlers and the timers which are due.
+        def __get__(self):
+            self._check_self()
+            return dict(iterations=self._poll_iterations,
+                        events=self._poll_events,
+                        event_time=self._poll_event_time,
+                        handler_time=self._poll_handler_time,
+                        last_iteration=dict(events=self._last_poll_events,
+                                            event_time=self._last_poll_event_time,
+                                            handler_time=self._last_poll_handler_time))
+
+    def reset_poll_statistics(self):
+        self._check_self()
+        self._poll_iterations = 0
+        self._poll_events = 0
+        self._poll_event_time = 0
+        self._poll_handler_time = 0
+
+    property timer_statistics:
+
+        def __get__(self):
+            self._check_self()
+            return dict(scheduled=len(self._timers)-self._cancelled_timers, cancelled=self._cancelled_timers)
+
     def add_event(self, object event, list accept_types):
         cdef pj_str_t event_pj
         cdef pj_str_t accept_types_pj[PJSIP_MAX_ACCEPT_COUNT]
@@ -779,11 +818,16 @@ cdef class PJSIPUA:
         _ua = NULL
         self._poll_log()
 
+    cdef int _has_observers(self, object event_name) except -1:
+        if self._event_filter is None:
+            return 1
+        return int(bool(self._event_filter(event_name)))
+
     cdef int _poll_log(self) except -1:
         cdef object event_name
         cdef dict event_params
         cdef list events
-        events = _get_clear_event_queue()
+        events = _get_clear_event_queue(self._has_observers("SIPEngineLog"))
         for event_name, event_params in events:
             self._event_handler(event_name, **event_params)
 
@@ -791,50 +835,85 @@ cdef class PJSIPUA:
         global _post_poll_handler_queue
         cdef int status
         cdef double now
+        cdef double start_time
+        cdef double event_time
         cdef object retval = None
         cdef float max_timeout
         cdef pj_time_val pj_max_timeout
-        cdef list timers
+        cdef unsigned int count
+        cdef unsigned int events
+        cdef list due_entries
+        cdef list entry
         cdef Timer timer
 
         self._check_self()
 
-        max_timeout = 0.100
+        max_timeout = self._max_poll_timeout
         while self._timers:
-            if not (<Timer>self._timers[0])._scheduled:
+            entry = self._timers[0]
+            if entry[2] is None:
                 # timer was cancelled
                 heapq.heappop(self._timers)
+                self._cancelled_timers -= 1
             else:
-                max_timeout = min(max((<Timer>self._timers[0]).schedule_time - time.time(), 0.0), max_timeout)
+                max_timeout = min(max(<double>entry[0] - time.time(), 0.0), max_timeout)
                 break
         pj_max_timeout.sec = int(max_timeout)
         pj_max_timeout.msec = int(max_timeout * 1000) % 1000
-        with nogil:
-            status = pjsip_endpt_handle_events(self._pjsip_endpoint._obj, &pj_max_timeout)
-        IF UNAME_SYSNAME == "Darwin":
-            if status not in [0, PJ_ERRNO_START_SYS + errno.EBADF]:
-                raise PJSIPError("Error while handling events", status)
-        ELSE:
-            if status != 0:
-                raise PJSIPError("Error while handling events", status)
+        start_time = time.time()
+        events = 0
+        while True:
+            count = 0
+            with nogil:
+                status = pjsip_endpt_handle_events2(self._pjsip_endpoint._obj, &pj_max_timeout, &count)
+            IF UNAME_SYSNAME == "Darwin":
+                if status not in [0, PJ_ERRNO_START_SYS + errno.EBADF]:
+                    raise PJSIPError("Error while handling events", status)
+            ELSE:
+                if status != 0:
+                    raise PJSIPError("Error while handling events", status)
+            events += count
+            # in batch mode, keep handling the events that are already pending without waiting for new ones
+            if count == 0 or events >= self._poll_batch_size:
+                break
+            pj_max_timeout.sec = 0
+            pj_max_timeout.msec = 0
+        now = time.time()
+        event_time = now - start_time
         _process_handler_queue(self, &_post_poll_handler_queue)
 
-        timers = list()
+        due_entries = list()
         now = time.time()
         while self._timers:
-            if not (<Timer>self._timers[0])._scheduled:
+            entry = self._timers[0]
+            if entry[2] is None:
                 # timer was cancelled
                 heapq.heappop(self._timers)
-            elif (<Timer>self._timers[0]).schedule_time <= now:
+                self._cancelled_timers -= 1
+            elif <double>entry[0] <= now:
                 # timer needs to be processed
-                timer = heapq.heappop(self._timers)
-                timers.append(timer)
+                heapq.heappop(self._timers)
+                timer = entry[2]
+                timer._heap_entry = None
+                due_entries.append(entry)
             else:
                 break
-        for timer in timers:
-            timer.call()
+        for entry in due_entries:
+            # a callback may have cancelled one of the timers that follow it, or cancelled and
+            # rescheduled it, in which case it fires when its new entry is due instead
+            timer = entry[2]
+            if timer._scheduled and timer._sequence == <unsigned long long>entry[1]:
+                timer.call()
 
         self._poll_log()
+
+        self._last_poll_events = events
+        self._last_poll_event_time = event_time
+        self._last_poll_handler_time = time.time() - start_time - event_time
+        self._poll_iterations += 1
+        self._poll_events += events
+        self._poll_event_time += self._last_poll_event_time
+        self._poll_handler_time += self._last_poll_handler_time
         if self._fatal_error:
             return True
         else:
@@ -864,12 +943,29 @@ cdef class PJSIPUA:
         return 0
 
     cdef int _add_timer(self, Timer timer) except -1:
-        heapq.heappush(self._timers, timer)
+        # The heap holds [schedule_time, sequence, timer] entries, the sequence number keeps timers
+        # scheduled for the same time in order without ever comparing the timers themselves.
+        self._timer_sequence += 1
+        timer._sequence = self._timer_sequence
+        timer._heap_entry = [timer.schedule_time, self._timer_sequence, timer]
+        heapq.heappush(self._timers, timer._heap_entry)
         return 0
 
     cdef int _remove_timer(self, Timer timer) except -1:
-        # Don't remove it from the heap, just mark it as not scheduled
+        # Don't remove the entry from the heap, just turn it into a tombstone, which is discarded when
+        # it reaches the top of the heap. Once tombstones make up more than half of the heap, they are
+        # all dropped at once.
         timer._scheduled = 0
+        if timer._heap_entry is None:
+            # already removed from the heap while being processed
+            return 0
+        timer._heap_entry[2] = None
+        timer._heap_entry = None
+        self._cancelled_timers += 1
+        if self._cancelled_timers > 64 and 2*self._cancelled_timers > len(self._timers):
+            self._timers = [entry for entry in self._timers if entry[2] is not None]
+            heapq.heapify(self._timers)
+            self._cancelled_timers = 0
         return 0
 
     cdef int _cb_rx_request(self, pjsip_rx_data *rdata) except 0:
@@ -1134,7 +1230,7 @@ cdef int _cb_trace_rx(pjsip_rx_data *rdata) with gil:
     except:
         return 0
     try:
-        if ua._trace_sip:
+        if ua._trace_sip and ua._has_observers("SIPEngineSIPTrace"):
             _add_event("SIPEngineSIPTrace",
                         dict(received=True, source_ip=rdata.pkt_info.src_name, source_port=rdata.pkt_info.src_port,
                              destination_ip=_pj_str_to_str(rdata.tp_info.transport.local_name.host),
@@ -1152,7 +1248,7 @@ cdef int _cb_trace_tx(pjsip_tx_data *tdata) with gil:
     except:
         return 0
     try:
-        if ua._trace_sip:
+        if ua._trace_sip and ua._has_observers("SIPEngineSIPTrace"):
             _add_event("SIPEngineSIPTrace",
                         dict(received=False,
                              source_ip=_pj_str_to_str(tdata.tp_info.transport.local_name.host),
@@ -11,7 +11,7 @@ import traceback
 import atexit
 
 from application import log
-from application.notification import NotificationCenter, NotificationData
+from application.notification import Any, NotificationCenter, NotificationData
 from application.python.types import Singleton
 from threading import Thread, RLock
 
@@ -39,6 +39,8 @@ class Engine(Thread):
                              "codecs": ["G722", "speex", "PCMU", "PCMA"],
                              "video_codecs": ["H264", "H263-1998", "VP8"],
                              "enable_colorbar_device": False,
+                             "poll_batch_size": 1,
+                             "max_poll_timeout": 0.100,
                              "events": {"conference":      ["application/conference-info+xml"],
                                         "message-summary": ["application/simple-message-summary"],
                                         "presence":        ["multipart/related", "application/rlmi+xml", "application/pidf+xml"],
@@ -97,7 +99,7 @@ class Engine(Thread):
         init_options = Engine.default_start_options.copy()
         init_options.update(self._options)
         try:
-            self._ua = PJSIPUA(self._handle_event, **init_options)
+            self._ua = PJSIPUA(self._handle_event, event_filter=self._has_observers, **init_options)
         except Exception:
             log.exception('Exception occurred while starting the Engine')
             exc_type, exc_val, exc_tb = sys.exc_info()
@@ -125,9 +127,18 @@ class Engine(Thread):
         del self._ua
         self.notification_center.post_notification('SIPEngineDidEnd', sender=self)
 
+    def _has_observers(self, event_name, sender=None):
+        # the lookup mirrors the one done by NotificationCenter.post_notification, it is used to avoid building
+        # notifications nobody will receive, which matters for high rate events such as SIPEngineLog
+        if sender is None:
+            sender = self
+        observers = self.notification_center.observers
+        return (Any, Any) in observers or (event_name, Any) in observers or (Any, sender) in observers or (event_name, sender) in observers
+
     def _handle_event(self, event_name, **kwargs):
         sender = kwargs.pop("obj", None)
         if sender is None:
             sender = self
-        self.notification_center.post_notification(event_name, sender, NotificationData(**kwargs))
+        if self._has_observers(event_name, sender):
+            self.notification_center.post_notification(event_name, sender, NotificationData(**kwargs))
 
@@ -9,14 +9,17 @@ resources prior the starting of a SIP session.
 from __future__ import absolute_import
 
 import re
+import sys
+from collections import OrderedDict
+from copy import copy
+from functools import partial
 from itertools import chain
+from threading import Lock
 from time import time
 from urlparse import urlparse
 
 # patch dns.entropy module which is not thread-safe
 import dns
-import sys
-from functools import partial
 from random import randint, randrange
 
 dns.entropy = dns.__class__('dns.entropy')
@@ -27,10 +30,10 @@ dns.entropy.between = randint
 
 sys.modules['dns.entropy'] = dns.entropy
 
-del partial, randint, randrange, sys
+del randint, randrange
 
 # replace standard select and socket modules with versions from eventlib
-from eventlib import coros, proc
+from eventlib import api, coros, proc
 from eventlib.green import select
 from eventlib.green import socket
 import dns.name
@@ -42,7 +45,7 @@ dns.query.select = select
 dns.query._set_polling_backend(dns.query._select_for)
 
 from application.notification import IObserver, NotificationCenter, NotificationData
-from application.python import Null, limit
+from application.python import Null
 from application.python.decorator import decorator, preserve_signature
 from application.python.types import Singleton
 from dns import exception, rdatatype
@@ -52,6 +55,7 @@ from zope.interface import implements
 from sipsimple.core import Route
 from sipsimple.threading import run_in_twisted_thread
 from sipsimple.threading.green import Command, InterruptCommand, run_in_waitable_green_thread
+from sipsimple.util import monotonic
 
 
 def domain_iterator(domain):
@@ -87,26 +91,103 @@ class DNSLookupError(Exception):
 
 class DNSCache(object):
     """
-    A simple DNS cache which uses twisted's timers to invalidate its expired
-    data.
+    A DNS cache holding at most max_size entries, keyed by the query name and
+    type. When full, the least recently used entry is evicted. Entries expire
+    lazily when they are looked up, while a single periodic timer removes the
+    expired entries that are no longer looked up.
+
+    Besides answers, the cache also stores NXDOMAIN and NoAnswer errors for
+    negative_ttl seconds (a negative_ttl of 0 disables negative caching).
     """
-    def __init__(self):
-        self.data = {}
+
+    def __init__(self, max_size=1000, negative_ttl=30, max_ttl=3600, sweep_interval=60):
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self.sweep_interval = sweep_interval
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+        self._sweep_timer = None
+
+    @property
+    def statistics(self):
+        with self.lock:
+            return dict(size=len(self.data), hits=self.hits, misses=self.misses, evictions=self.evictions)
 
     def get(self, key):
-        return self.data.get(key, None)
+        return self._get(self._make_key(key), error=False)
+
+    def get_error(self, key):
+        return self._get(self._make_key(key), error=True)
 
     def put(self, key, value):
-        expiration = value.expiration-time()
-        if expiration > 0:
-            self.data[key] = value
-            reactor.callLater(limit(expiration, max=3600), self.data.pop, key, None)
+        self._put(self._make_key(key), value, value.expiration-time())
+
+    def put_error(self, key, error):
+        if self.negative_ttl > 0:
+            self._put(self._make_key(key), error, self.negative_ttl)
 
     def flush(self, key=None):
-        if key is not None:
+        with self.lock:
+            if key is not None:
+                self.data.pop(self._make_key(key), None)
+            else:
+                self.data.clear()
+
+    @staticmethod
+    def _make_key(key):
+        # dnspython uses (name, rdtype, rdclass) keys, with name being a dns.name.Name instance
+        name, rdtype = key[:2]
+        if isinstance(name, dns.name.Name):
+            name = name.to_text()
+        elif isinstance(name, unicode):
+            # use the IDNA form of the name, which is what dnspython queries and uses in its own keys
+            name = dns.name.from_text(name).to_text()
+        if not name.endswith('.'):
+            name += '.'
+        return name.lower(), rdtype
+
+    def _get(self, key, error):
+        # the negative entries are checked before each query, so only the lookups for answers count as misses
+        with self.lock:
+            try:
+                expiration, value = self.data.pop(key)
+            except KeyError:
+                value = None
+            else:
+                if expiration > monotonic():
+                    self.data[key] = expiration, value
+                else:
+                    value = None
+            if value is not None and isinstance(value, exception.DNSException) is error:
+                self.hits += 1
+                return value
+            elif not error:
+                self.misses += 1
+            return None
+
+    def _put(self, key, value, ttl):
+        if ttl <= 0:
+            return
+        with self.lock:
             self.data.pop(key, None)
-        else:
-            self.data = {}
+            while len(self.data) >= self.max_size:
+                self.data.popitem(last=False)
+                self.evictions += 1
+            self.data[key] = monotonic() + min(ttl, self.max_ttl), value
+        if self._sweep_timer is None:
+            self._sweep_timer = reactor.callLater(self.sweep_interval, self._sweep)
+
+    def _sweep(self):
+        now = monotonic()
+        with self.lock:
+            for key in [key for key, (expiration, value) in self.data.iteritems() if expiration <= now]:
+                del self.data[key]
+            pending = bool(self.data)
+        self._sweep_timer = reactor.callLater(self.sweep_interval, self._sweep) if pending else None
 
 
 class InternalResolver(dns.resolver.Resolver):
@@ -121,24 +202,74 @@ class DNSResolver(dns.resolver.Resolver):
     """
     The resolver used by DNSLookup.
 
-    The lifetime setting on it applies to all the queries made on this resolver.
-    Each time a query is performed, its duration is subtracted from the lifetime
-    value.
+    The lifetime setting on it applies to all the queries made on this resolver
+    and on the resolvers cloned from it: the first query sets a deadline that
+    is lifetime seconds away and all queries that are made, be it one after
+    another or in parallel using clones, must complete before that deadline.
+
+    Queries for the same name and type that are made while an identical one
+    is in progress, by any resolver, wait for its result instead of sending
+    another request. If that query times out while the waiting resolver still
+    has time left, the waiting resolver makes the query itself.
     """
 
+    _pending_queries = {}
+
     def __init__(self):
         dns.resolver.Resolver.__init__(self, configure=False)
         dns_manager = DNSManager()
         self.search = dns_manager.search
         self.domain = dns_manager.domain
         self.nameservers = dns_manager.nameservers
+        self.deadline = None
 
-    def query(self, *args, **kw):
-        start_time = time()
+    def clone(self):
+        """
+        Return a resolver with the same settings that shares the deadline with
+        this one. It is used to run queries in parallel green threads.
+        """
+        if self.deadline is None:
+            self.deadline = monotonic() + self.lifetime
+        return copy(self)
+
+    def query(self, qname, rdtype=rdatatype.A, *args, **kw):
+        negative_cache = self.cache if isinstance(self.cache, DNSCache) else None
+        if negative_cache is not None:
+            error = negative_cache.get_error((qname, rdtype))
+            if error is not None:
+                raise error
+        if self.deadline is None:
+            self.deadline = monotonic() + self.lifetime
+        key = DNSCache._make_key((qname, rdtype))
+        while True:
+            self.lifetime = max(self.deadline - monotonic(), 0)
+            pending_query = self._pending_queries.get(key)
+            if pending_query is None:
+                break
+            try:
+                with api.timeout(self.lifetime, dns.resolver.Timeout()):
+                    return pending_query.wait()
+            except dns.resolver.Timeout:
+                # The query we waited for may have timed out according to the timeout and lifetime of
+                # the resolver which made it. If this resolver has time left, it makes the query again.
+                if monotonic() >= self.deadline:
+                    raise
+        self._pending_queries[key] = pending_query = coros.event()
         try:
-            return dns.resolver.Resolver.query(self, *args, **kw)
+            answer = dns.resolver.Resolver.query(self, qname, rdtype, *args, **kw)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer), e:
+            if negative_cache is not None:
+                negative_cache.put_error((qname, rdtype), e)
+            pending_query.send_exception(*sys.exc_info())
+            raise
+        except Exception:
+            pending_query.send_exception(*sys.exc_info())
+            raise
+        else:
+            pending_query.send(answer)
+            return answer
         finally:
-            self.lifetime -= min(self.lifetime, time()-start_time)
+            del self._pending_queries[key]
 
 
 class SRVResult(object):
@@ -303,13 +434,12 @@ class DNSLookup(object):
                 if pointers:
                     return [Route(address=result.address, port=result.port, transport=naptr_service_transport_map[result.service]) for result in pointers]
                 else:
-                    # If that fails, try SRV lookup
+                    # If that fails, try SRV lookup for all the supported transports at the same time
+                    record_names = ['%s.%s' % (transport_service_map[transport], uri.host) for transport in supported_transports]
+                    services = self._lookup_srv_records(resolver, record_names, log_context=log_context)
                     routes = []
-                    for transport in supported_transports:
-                        record_name = '%s.%s' % (transport_service_map[transport], uri.host)
-                        services = self._lookup_srv_records(resolver, [record_name], log_context=log_context)
-                        if services[record_name]:
-                            routes.extend(Route(address=result.address, port=result.port, transport=transport) for result in services[record_name])
+                    for transport, record_name in zip(supported_transports, record_names):
+                        routes.extend(Route(address=result.address, port=result.port, transport=transport) for result in services[record_name])
                     if routes:
                         return routes
                     else:
@@ -325,6 +455,33 @@ class DNSLookup(object):
         else:
             raise DNSLookupError("No routes found for SIP URI %s" % uri)
 
+    @run_in_waitable_green_thread
+    def prefetch(self, uris, supported_transports, timeout=3.0, lifetime=15.0):
+        """
+        Performs the lookups made by lookup_sip_proxy for each of the given SIP
+        URIs, all in parallel, in order to have the results in the cache before
+        they are needed, for example when registering many accounts which use
+        the same few registrars. The URIs, supported transports, timeout and
+        lifetime must be the ones the later lookups will use, otherwise the
+        lookups will make different queries. Lookups for the same records that
+        are started while the prefetch is running wait for its queries.
+
+        It returns a dictionary mapping the string representation of each URI
+        to the list of Route objects found for it, which is empty if the lookup
+        failed.
+        """
+        lookups = OrderedDict()
+        for uri in uris:
+            if str(uri) not in lookups:
+                lookups[str(uri)] = self.lookup_sip_proxy(uri, supported_transports, timeout, lifetime)
+        routes = {}
+        for uri, lookup in lookups.iteritems():
+            try:
+                routes[uri] = lookup.wait()
+            except DNSLookupError:
+                routes[uri] = []
+        return routes
+
     @run_in_waitable_green_thread
     @post_dns_lookup_notifications
     def lookup_xcap_server(self, uri, timeout=3.0, lifetime=15.0):
@@ -368,53 +525,60 @@ class DNSLookup(object):
 
 
     def _lookup_a_records(self, resolver, hostnames, additional_records=[], log_context={}):
-        notification_center = NotificationCenter()
         additional_addresses = dict((rset.name.to_text(), rset) for rset in additional_records if rset.rdtype == rdatatype.A)
         addresses = {}
+        queried_hostnames = []
         for hostname in hostnames:
             if hostname in additional_addresses:
                 addresses[hostname] = [r.address for r in additional_addresses[hostname]]
-            else:
-                try:
-                    answer = resolver.query(hostname, rdatatype.A)
-                except dns.resolver.Timeout, e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                    raise
-                except exception.DNSException, e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                    addresses[hostname] = []
-                else:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
-                    addresses[hostname] = [r.address for r in answer.rrset]
+            elif hostname not in queried_hostnames:
+                queried_hostnames.append(hostname)
+        results = self._run_in_parallel(resolver, self._lookup_a_record, queried_hostnames, log_context)
+        addresses.update(zip(queried_hostnames, results))
         return addresses
 
+    def _lookup_a_record(self, resolver, hostname, log_context):
+        notification_center = NotificationCenter()
+        try:
+            answer = resolver.query(hostname, rdatatype.A)
+        except dns.resolver.Timeout, e:
+            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+            raise
+        except exception.DNSException, e:
+            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+            return []
+        else:
+            notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='A', query_name=str(hostname), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
+            return [r.address for r in answer.rrset]
 
     def _lookup_srv_records(self, resolver, srv_names, additional_records=[], log_context={}):
-        notification_center = NotificationCenter()
         additional_services = dict((rset.name.to_text(), rset) for rset in additional_records if rset.rdtype == rdatatype.SRV)
-        services = {}
-        for srv_name in srv_names:
-            services[srv_name] = []
-            if srv_name in additional_services:
-                addresses = self._lookup_a_records(resolver, [r.target.to_text() for r in additional_services[srv_name]], additional_records)
-                for record in additional_services[srv_name]:
-                    services[srv_name].extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
-            else:
-                try:
-                    answer = resolver.query(srv_name, rdatatype.SRV)
-                except dns.resolver.Timeout, e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                    raise
-                except exception.DNSException, e:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
-                else:
-                    notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
-                    addresses = self._lookup_a_records(resolver, [r.target.to_text() for r in answer.rrset], answer.response.additional, log_context)
-                    for record in answer.rrset:
-                        services[srv_name].extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
-            services[srv_name].sort(key=lambda result: (result.priority, -result.weight))
-        return services
+        srv_names = list(OrderedDict.fromkeys(srv_names))
+        results = self._run_in_parallel(resolver, self._lookup_srv_record, srv_names, additional_services, additional_records, log_context)
+        return dict(zip(srv_names, results))
 
+    def _lookup_srv_record(self, resolver, srv_name, additional_services, additional_records, log_context):
+        notification_center = NotificationCenter()
+        results = []
+        if srv_name in additional_services:
+            addresses = self._lookup_a_records(resolver, [r.target.to_text() for r in additional_services[srv_name]], additional_records)
+            for record in additional_services[srv_name]:
+                results.extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
+        else:
+            try:
+                answer = resolver.query(srv_name, rdatatype.SRV)
+            except dns.resolver.Timeout, e:
+                notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+                raise
+            except exception.DNSException, e:
+                notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=None, error=e, **log_context))
+            else:
+                notification_center.post_notification('DNSLookupTrace', sender=self, data=NotificationData(query_type='SRV', query_name=str(srv_name), nameservers=resolver.nameservers, answer=answer, error=None, **log_context))
+                addresses = self._lookup_a_records(resolver, [r.target.to_text() for r in answer.rrset], answer.response.additional, log_context)
+                for record in answer.rrset:
+                    results.extend(SRVResult(record.priority, record.weight, record.port, addr) for addr in addresses.get(record.target.to_text(), ()))
+        results.sort(key=lambda result: (result.priority, -result.weight))
+        return results
 
     def _lookup_naptr_record(self, resolver, domain, services, log_context={}):
         notification_center = NotificationCenter()
@@ -435,6 +599,26 @@ class DNSLookup(object):
         pointers.sort(key=lambda result: (result.order, result.preference))
         return pointers
 
+    def _run_in_parallel(self, resolver, function, items, *args):
+        """
+        Call function(resolver, item, *args) for each of the items, each in its
+        own green thread using a clone of the resolver, and return the results
+        in the order of the items. If any of the calls failed, the first error
+        is raised after all of them have finished.
+        """
+        if len(items) <= 1:
+            return [function(resolver, item, *args) for item in items]
+        def call(item):
+            try:
+                return function(resolver.clone(), item, *args), None
+            except Exception:
+                return None, sys.exc_info()
+        results = [job.wait() for job in [proc.spawn(call, item) for item in items]]
+        for result, exc_info in results:
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+        return [result for result, exc_info in results]
+
 
 class DNSManager(object):
     __metaclass__ = Singleton
@@ -7,6 +7,7 @@ __all__ = ['ParserError',
            'IterateItems',
            'All',
            'parse_qname',
+           'ParseCache',
            'XMLDocument',
            'XMLAttribute',
            'XMLElementID',
@@ -42,13 +43,16 @@ __all__ = ['ParserError',
            'XMLStringListElement']
 
 
+import hashlib
 import os
 import sys
 import urllib
-from collections import defaultdict, deque
+import weakref
+from collections import OrderedDict, defaultdict, deque
 from copy import deepcopy
 from decimal import Decimal
-from itertools import chain, izip
+from itertools import chain, count, izip
+from threading import Lock, RLock
 from weakref import WeakValueDictionary
 
 from application.python import Null
@@ -88,16 +92,74 @@ def parse_qname(qname):
         return None, qname
 
 
+class ParseCache(object):
+    """
+    A cache of parsed documents holding at most max_size entries, keyed by the
+    document type and the digest of the document content. When full, the
+    least recently used entry is evicted.
+
+    Caching is enabled for a document type by setting its parse_cache
+    attribute to an instance of this class, which can be shared between
+    multiple document types. A cache hit skips parsing and validating the
+    document, but every caller still gets its own copy of the parsed document.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    @property
+    def statistics(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(size=len(self.data), hits=self.hits, misses=self.misses, evictions=self.evictions, hit_rate=float(self.hits)/lookups if lookups else 0.0)
+
+    @staticmethod
+    def make_key(document_type, content):
+        return document_type, hashlib.sha1(content).digest()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            while len(self.data) >= self.max_size:
+                self.data.popitem(last=False)
+                self.evictions += 1
+            self.data[key] = value
+
+    def flush(self):
+        with self.lock:
+            self.data.clear()
+
+
 ## XMLDocument
 
 class XMLDocumentType(type):
+    # compiled schemas are shared by the document classes that use the same schema files
+    schema_cache = {}
+
     def __init__(cls, name, bases, dct):
         cls.nsmap = {}
         cls.schema_map = {}
         cls.element_map = {}
         cls.root_element = None
         cls.schema = None
-        cls.parser = None
+        cls.parser = etree.XMLParser(remove_blank_text=True)
+        cls.validation_counter = count()
         for base in reversed(bases):
             if hasattr(base, 'element_map'):
                 cls.element_map.update(base.element_map)
@@ -117,22 +179,26 @@ class XMLDocumentType(type):
                 for document_subclass in document_class.__subclasses__():
                     update_schema(document_subclass)
             update_schema(XMLDocument)
+        elif name == 'validation_policy' and value not in ('always', 'sampled', 'untrusted'):
+            raise ValueError("invalid validation policy: %r" % value)
         else:
             super(XMLDocumentType, cls).__setattr__(name, value)
 
     def _update_schema(cls):
         if cls.schema_map:
             location_map = {ns: urllib.quote(os.path.abspath(os.path.join(cls.schema_path, schema_file)).replace('\\', '//')) for ns, schema_file in cls.schema_map.iteritems()}
-            schema = """<?xml version="1.0"?>
-                <xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
-                    %s
-                </xs:schema>
-            """ % '\r\n'.join('<xs:import namespace="%s" schemaLocation="%s"/>' % (namespace, schema_location) for namespace, schema_location in location_map.iteritems())
-            cls.schema = etree.XMLSchema(etree.XML(schema))
-            cls.parser = etree.XMLParser(schema=cls.schema, remove_blank_text=True)
+            key = frozenset(location_map.iteritems())
+            try:
+                cls.schema = XMLDocumentType.schema_cache[key]
+            except KeyError:
+                schema = """<?xml version="1.0"?>
+                    <xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+                        %s
+                    </xs:schema>
+                """ % '\r\n'.join('<xs:import namespace="%s" schemaLocation="%s"/>' % (namespace, schema_location) for namespace, schema_location in location_map.iteritems())
+                cls.schema = XMLDocumentType.schema_cache[key] = etree.XMLSchema(etree.XML(schema))
         else:
             cls.schema = None
-            cls.parser = etree.XMLParser(remove_blank_text=True)
 
 
 class XMLDocument(object):
@@ -142,29 +208,77 @@ class XMLDocument(object):
     content_type = None
     schema_path = os.path.join(os.path.dirname(__file__), 'xml-schemas')
 
+    # Controls which documents are validated against the schema:
+    #  - always: all documents
+    #  - sampled: one in every validation_sample_interval documents
+    #  - untrusted: the documents which are not marked as coming from a trusted source (built documents are trusted)
+    validation_policy = 'always'
+    validation_sample_interval = 100
+
+    # Set to a ParseCache instance to cache the documents parsed from strings
+    parse_cache = None
+
     @classmethod
-    def parse(cls, document):
+    def must_validate(cls, trusted=False):
+        if cls.schema is None:
+            return False
+        elif cls.validation_policy == 'sampled':
+            return next(cls.validation_counter) % cls.validation_sample_interval == 0
+        elif cls.validation_policy == 'untrusted':
+            return not trusted
+        else:
+            return True
+
+    @classmethod
+    def parse(cls, document, lazy=False, trusted=False):
+        # When lazy is True, the items of the list elements in the document are only turned into XMLElement objects
+        # when the list is first accessed, so errors in them will only be raised at that point, as ParserError. This
+        # is only meant for documents used by the code that parses them, documents which are handed to others, like
+        # the ones sent in notifications, should be parsed eagerly so that they are known to be valid.
         try:
-            if isinstance(document, str):
-                xml = etree.XML(document, parser=cls.parser)
-            elif isinstance(document, unicode):
-                xml = etree.XML(document.encode('utf-8'), parser=cls.parser)
+            if isinstance(document, unicode):
+                document = document.encode('utf-8')
+            if isinstance(document, str) and cls.parse_cache is not None:
+                xml = cls._parse_cached(document, trusted)
             else:
-                xml = etree.parse(document, parser=cls.parser).getroot()
-            if cls.schema is not None:
-                cls.schema.assertValid(xml)
-            return cls.root_element.from_element(xml, xml_document=cls)
+                if isinstance(document, str):
+                    xml = etree.XML(document, parser=cls.parser)
+                else:
+                    xml = etree.parse(document, parser=cls.parser).getroot()
+                if cls.must_validate(trusted):
+                    cls.schema.assertValid(xml)
+            return cls.root_element.from_element(xml, xml_document=cls, lazy=lazy)
         except (etree.DocumentInvalid, etree.XMLSyntaxError, ValueError), e:
             raise ParserError(str(e))
 
+    @classmethod
+    def _parse_cached(cls, document, trusted):
+        # The cache holds the parsed tree together with a flag indicating whether it was validated and only hands
+        # out copies of it, since the XMLElement objects built on top of a tree modify it.
+        key = ParseCache.make_key(cls, document)
+        entry = cls.parse_cache.get(key)
+        if entry is None:
+            xml = etree.XML(document, parser=cls.parser)
+            validated = cls.must_validate(trusted)
+            if validated:
+                cls.schema.assertValid(xml)
+            cls.parse_cache.put(key, (deepcopy(xml), validated))
+            return xml
+        xml, validated = entry
+        if not validated and cls.must_validate(trusted):
+            cls.schema.assertValid(xml)
+            cls.parse_cache.put(key, (xml, True))
+        return deepcopy(xml)
+
     @classmethod
     def build(cls, root_element, encoding=None, pretty_print=False, validate=True):
         if type(root_element) is not cls.root_element:
             raise TypeError("can only build XML documents from root elements of type %s" % cls.root_element.__name__)
         element = root_element.to_element()
-        if validate and cls.schema is not None:
+        if validate and cls.must_validate(trusted=True):
             cls.schema.assertValid(element)
-        # Cleanup namespaces and move element NS mappings to the global scope.
+        # Cleanup namespaces and move element NS mappings to the global scope. The children are copied, since the
+        # element may be used by other threads while it is serialized and cleaning up the namespaces modifies them.
         normalized_element = etree.Element(element.tag, attrib=element.attrib, nsmap=dict(chain(element.nsmap.iteritems(), cls.nsmap.iteritems())))
         normalized_element.text = element.text
         normalized_element.tail = element.tail
@@ -319,8 +433,10 @@ class XMLElementChild(object):
             same_value = True
         if old_value is not None:
             obj.element.remove(old_value.element)
+            obj._unlink_child(old_value)
         if value is not None:
             obj._insert_element(value.element)
+            obj._link_child(value)
         self.values[obj] = value
         if not same_value:
             obj.__dirty__ = True
@@ -335,6 +451,7 @@ class XMLElementChild(object):
         else:
             if old_value is not None:
                 obj.element.remove(old_value.element)
+                obj._unlink_child(old_value)
                 obj.__dirty__ = True
         if self.ondel:
             self.ondel(obj, self)
@@ -417,8 +534,10 @@ class XMLElementChoiceChild(object):
             same_value = True
         if old_value is not None:
             obj.element.remove(old_value.element)
+            obj._unlink_child(old_value)
         if value is not None:
             obj._insert_element(value.element)
+            obj._link_child(value)
         self.values[obj] = value
         if not same_value:
             obj.__dirty__ = True
@@ -433,6 +552,7 @@ class XMLElementChoiceChild(object):
         else:
             if old_value is not None:
                 obj.element.remove(old_value.element)
+                obj._unlink_child(old_value)
                 obj.__dirty__ = True
         if self.ondel:
             self.ondel(obj, self)
@@ -553,20 +673,52 @@ class XMLElement(XMLElementBase):
         self.element = etree.Element(self.qname, nsmap=self._xml_document.nsmap)
         self.__dirty__ = True
 
+    # The dirty state of the children is not computed by walking the tree. Instead, each child keeps a reference to
+    # its parent and reports to it when its dirty state changes, while each element keeps track of its dirty children
+    # in __dirty_children__. This makes checking the dirty state of an element constant time, regardless of its size.
+
     def __get_dirty__(self):
-        return (self.__dict__['__dirty__']
-                or any(child.__dirty__ for child in (getattr(self, name) for name in self._xml_element_children) if child is not None)
-                or super(XMLElement, self).__get_dirty__())
+        return self.__dict__.get('__dirty__', False) or bool(self.__dict__.get('__dirty_children__')) or super(XMLElement, self).__get_dirty__()
 
     def __set_dirty__(self, dirty):
+        was_dirty = self.__get_dirty__()
         super(XMLElement, self).__set_dirty__(dirty)
         if not dirty:
-            for child in (child for child in (getattr(self, name) for name in self._xml_element_children) if child is not None):
+            for child in self.__dict__.get('__dirty_children__', {}).values():
                 child.__dirty__ = dirty
         self.__dict__['__dirty__'] = dirty
+        if self.__get_dirty__() != was_dirty:
+            self._update_parent()
 
     __dirty__ = property(__get_dirty__, __set_dirty__)
 
+    def _link_child(self, child):
+        child.__dict__['__parent__'] = weakref.ref(self)
+        if child.__dirty__:
+            self._update_child(child, True)
+
+    def _unlink_child(self, child):
+        parent_ref = child.__dict__.get('__parent__')
+        if parent_ref is not None and parent_ref() is self:
+            del child.__dict__['__parent__']
+        self._update_child(child, False)
+
+    def _update_child(self, child, dirty):
+        was_dirty = self.__get_dirty__()
+        dirty_children = self.__dict__.setdefault('__dirty_children__', {})
+        if dirty:
+            dirty_children[id(child)] = child
+        else:
+            dirty_children.pop(id(child), None)
+        if self.__get_dirty__() != was_dirty:
+            self._update_parent()
+
+    def _update_parent(self):
+        parent_ref = self.__dict__.get('__parent__')
+        parent = parent_ref() if parent_ref is not None else None
+        if parent is not None:
+            parent._update_child(self, self.__get_dirty__())
+
     def check_validity(self):
         # check attributes
         for name, attribute in self._xml_attributes.iteritems():
@@ -596,10 +748,12 @@ class XMLElement(XMLElementBase):
         return self.element
 
     @classmethod
-    def from_element(cls, element, xml_document=None):
+    def from_element(cls, element, xml_document=None, lazy=False):
         obj = cls.__new__(cls)
         obj._xml_document = xml_document if xml_document is not None else cls._xml_document
         obj.element = element
+        if lazy:
+            obj.__dict__['__lazy__'] = True
         # set known attributes
         for name, attribute in cls._xml_attributes.iteritems():
             xmlvalue = element.get(attribute.xmlname, None)
@@ -613,7 +767,7 @@ class XMLElement(XMLElementBase):
             element_child, type = cls._xml_children_qname_map.get(child.tag, (None, None))
             if element_child is not None:
                 try:
-                    value = type.from_element(child, xml_document=obj._xml_document)
+                    value = type.from_element(child, xml_document=obj._xml_document, lazy=lazy)
                 except ValidationError:
                     pass # we should accept partially valid documents
                 else:
@@ -657,17 +811,24 @@ class XMLElement(XMLElementBase):
         delattr(cls, attribute)
 
     def _insert_element(self, element):
-        if element in self.element:
+        if element.getparent() is self.element:
             return
-        order = self._xml_children_order.get(element.tag, self._xml_children_order.get(None, sys.maxint))
-        for i in xrange(len(self.element)):
-            child_order = self._xml_children_order.get(self.element[i].tag, self._xml_children_order.get(None, sys.maxint))
-            if child_order > order:
-                position = i
+        children_order = self._xml_children_order
+        default_order = children_order.get(None, sys.maxint)
+        order = children_order.get(element.tag, default_order)
+        # the children are kept sorted by their order, so the insertion point is searched for starting with the last
+        # child, which makes adding an element after the others of the same order (like list items) a constant time
+        # operation instead of one that is linear in the number of children
+        for child in self.element.iterchildren(reversed=True):
+            if children_order.get(child.tag, default_order) <= order:
+                next_child = child.getnext()
+                if next_child is None:
+                    self.element.append(element)
+                else:
+                    next_child.addprevious(element)
                 break
         else:
-            position = len(self.element)
-        self.element.insert(position, element)
+            self.element.insert(0, element)
 
     def __eq__(self, other):
         if isinstance(other, XMLElement):
@@ -719,14 +880,14 @@ class XMLRootElement(XMLElement):
         self.__cache__ = WeakValueDictionary({self.element: self})
 
     @classmethod
-    def from_element(cls, element, xml_document=None):
-        obj = super(XMLRootElement, cls).from_element(element, xml_document)
+    def from_element(cls, element, xml_document=None, lazy=False):
+        obj = super(XMLRootElement, cls).from_element(element, xml_document, lazy)
         obj.__cache__ = WeakValueDictionary({obj.element: obj})
         return obj
 
     @classmethod
-    def parse(cls, document):
-        return cls._xml_document.parse(document)
+    def parse(cls, document, lazy=False, trusted=False):
+        return cls._xml_document.parse(document, lazy=lazy, trusted=trusted)
 
     def toxml(self, encoding=None, pretty_print=False, validate=True):
         return self._xml_document.build(self, encoding=encoding, pretty_print=pretty_print, validate=validate)
@@ -814,6 +975,7 @@ class XMLListMixin(XMLElementBase):
     __metaclass__ = XMLListMixinType
 
     _xml_item_type = None
+    _lazy_lock = RLock()
 
     def __new__(cls, *args, **kw):
         if cls._xml_item_type is None:
@@ -824,7 +986,25 @@ class XMLListMixin(XMLElementBase):
         return instance
 
     def __contains__(self, item):
-        return item in self._element_map.itervalues()
+        # items are found by identity or by their id without going through the list, only the items which do not
+        # have an id need to be compared with the given item one by one
+        if isinstance(item, XMLElement):
+            if self._element_map.get(item.element) is item:
+                return True
+            xml_id = item._xml_id
+        else:
+            xml_id = item
+        if xml_id is not None:
+            try:
+                for mapping in self._xmlid_map.itervalues():
+                    value = mapping.get(xml_id)
+                    if value is not None and value == item:
+                        return True
+            except TypeError:
+                pass
+        if len(self._element_map) == sum(len(mapping) for mapping in self._xmlid_map.itervalues()):
+            return False
+        return any(value == item for value in self._element_map.itervalues() if getattr(value, '_xml_id', None) is None)
 
     def __iter__(self):
         return (self._element_map[element] for element in self.element if element in self._element_map)
@@ -874,33 +1054,50 @@ class XMLListMixin(XMLElementBase):
         else:
             self.remove(self._xmlid_map[cls][id])
 
-    def __get_dirty__(self):
-        return any(item.__dirty__ for item in self._element_map.itervalues()) or super(XMLListMixin, self).__get_dirty__()
-
-    def __set_dirty__(self, dirty):
-        super(XMLListMixin, self).__set_dirty__(dirty)
-        if not dirty:
-            for item in self._element_map.itervalues():
-                item.__dirty__ = dirty
+    def __getattr__(self, name):
+        # the items of lazily parsed lists are created when the maps holding them are first accessed, the maps are
+        # only set once they are complete
+        if name in ('_element_map', '_xmlid_map') and self.__dict__.get('__lazy__', False):
+            with self._lazy_lock:
+                if name not in self.__dict__:
+                    element_map = {}
+                    xmlid_map = defaultdict(dict)
+                    try:
+                        self._parse_items(self.element, element_map, xmlid_map)
+                    except ValueError, e:
+                        raise ParserError(str(e))
+                    self.__dict__.update(_element_map=element_map, _xmlid_map=xmlid_map)
+            return self.__dict__[name]
+        raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
 
     def _parse_element(self, element):
         super(XMLListMixin, self)._parse_element(element)
-        self._element_map.clear()
-        self._xmlid_map.clear()
+        if self.__dict__.get('__lazy__', False):
+            with self._lazy_lock:
+                self.__dict__.pop('_element_map', None)
+                self.__dict__.pop('_xmlid_map', None)
+        else:
+            self._element_map.clear()
+            self._xmlid_map.clear()
+            self._parse_items(element, self._element_map, self._xmlid_map)
+
+    def _parse_items(self, element, element_map, xmlid_map):
+        lazy = self.__dict__.get('__lazy__', False)
         for child in element[:]:
             child_class = self._xml_document.get_element(child.tag, type(None))
             if child_class in self._xml_item_element_types or issubclass(child_class, self._xml_item_extension_types):
                 try:
-                    value = child_class.from_element(child, xml_document=self._xml_document)
+                    value = child_class.from_element(child, xml_document=self._xml_document, lazy=lazy)
                 except ValidationError:
                     pass
                 else:
-                    if value._xml_id is not None and value._xml_id in self._xmlid_map[child_class]:
+                    if value._xml_id is not None and value._xml_id in xmlid_map[child_class]:
                         element.remove(child)
                     else:
                         if value._xml_id is not None:
-                            self._xmlid_map[child_class][value._xml_id] = value
-                        self._element_map[value.element] = value
+                            xmlid_map[child_class][value._xml_id] = value
+                        element_map[value.element] = value
+                        self._link_child(value)
 
     def _build_element(self):
         super(XMLListMixin, self)._build_element()
@@ -921,10 +1118,12 @@ class XMLListMixin(XMLElementBase):
             self.element.remove(old_item.element)
             del self._xmlid_map[item.__class__][item._xml_id]
             del self._element_map[old_item.element]
+            self._unlink_child(old_item)
         self._insert_element(item.element)
         if item._xml_id is not None:
             self._xmlid_map[item.__class__][item._xml_id] = item
         self._element_map[item.element] = item
+        self._link_child(item)
         if not same_value:
             self.__dirty__ = True
 
@@ -933,6 +1132,7 @@ class XMLListMixin(XMLElementBase):
         if item._xml_id is not None:
             del self._xmlid_map[item.__class__][item._xml_id]
         del self._element_map[item.element]
+        self._unlink_child(item)
         self.__dirty__ = True
 
     def update(self, sequence):
@@ -14,6 +14,9 @@ from sipsimple.payloads import ValidationError
 class MessageSummary(object):
     content_type = "application/simple-message-summary"
 
+    # Set to a sipsimple.payloads.ParseCache instance to cache the parsed summaries
+    parse_cache = None
+
     def __init__(self, messages_waiting=False, message_account=None, summaries=None, optional_headers=None):
         self.messages_waiting = messages_waiting
         self.message_account = message_account
@@ -22,6 +25,18 @@ class MessageSummary(object):
 
     @classmethod
     def parse(cls, content):
+        if cls.parse_cache is None:
+            return cls._parse(content)
+        key = cls.parse_cache.make_key(cls, content)
+        summary = cls.parse_cache.get(key)
+        if summary is None:
+            summary = cls._parse(content)
+            cls.parse_cache.put(key, summary)
+        # the cached summary is never handed out, so that changes made by the callers do not affect it
+        return cls(summary.messages_waiting, summary.message_account, dict((name, dict(value)) for name, value in summary.summaries.iteritems()), [list(headers) for headers in summary.optional_headers])
+
+    @classmethod
+    def _parse(cls, content):
         message = StringIO(content)
         summary = cls()
         tmp_headers = []
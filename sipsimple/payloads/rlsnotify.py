@@ -4,6 +4,9 @@
 __all__ = ['RLSNotify']
 
 import email
+import re
+
+from threading import Lock
 
 from sipsimple.payloads import IterateItems, ParserError
 from sipsimple.payloads import rlmi, pidf
@@ -19,9 +22,68 @@ class ResourceURI(unicode):
         return NotImplemented if equal is NotImplemented else not equal
 
 
+class MultipartPart(object):
+    """A part of a multipart body, which only copies its content out of the body when it is requested"""
+
+    header_separator_re = re.compile(r'^\r?\n', re.MULTILINE)
+    header_continuation_re = re.compile(r'\r?\n[ \t]+')
+
+    def __init__(self, body, start, end):
+        match = self.header_separator_re.search(body, start, end)
+        if match is None:
+            header_block, self._start = body[start:end], end
+        else:
+            header_block, self._start = body[start:match.start()], match.end()
+        self._body = body
+        self._end = end
+        self.headers = {}
+        for line in self.header_continuation_re.sub(' ', header_block).splitlines():
+            name, separator, value = line.partition(':')
+            if separator:
+                self.headers.setdefault(name.strip().lower(), value.strip())
+
+    def __getitem__(self, name):
+        return self.headers.get(name.lower())
+
+    def get_content_type(self):
+        return self.headers.get('content-type', 'text/plain').partition(';')[0].strip().lower()
+
+    def get_payload(self):
+        return self._body[self._start:self._end]
+
+    @classmethod
+    def split(cls, body, boundary, start=0):
+        """Split a multipart body starting at the given offset in a single pass, yielding its parts in order"""
+        delimiter = '--' + boundary
+        position = cls._find_delimiter(body, delimiter, start)
+        if position == -1:
+            return
+        while not body.startswith('--', position + len(delimiter)):
+            line_end = body.find('\n', position + len(delimiter))
+            if line_end == -1:
+                return
+            start = line_end + 1
+            position = cls._find_delimiter(body, delimiter, start)
+            if position == -1:
+                yield cls(body, start, len(body))
+                return
+            end = position - 2 if body.startswith('\r\n', position - 2) else position - 1
+            yield cls(body, start, max(start, end))
+
+    @staticmethod
+    def _find_delimiter(body, delimiter, position):
+        while True:
+            position = body.find(delimiter, position)
+            if position <= 0 or body[position - 1] == '\n':
+                return position
+            position += 1
+
+
 class Resource(object):
     __prioritymap__ = dict(active=10, pending=20, terminated=30)
 
+    _pidf_lock = Lock()
+
     def __init__(self, uri, name=None, state=None, reason=None, pidf_list=None):
         self.uri = ResourceURI(uri)
         self.name = name
@@ -29,8 +91,48 @@ class Resource(object):
         self.reason = reason
         self.pidf_list = pidf_list or []
 
+    def __eq__(self, other):
+        if isinstance(other, Resource):
+            if self is other:
+                return True
+            if (self.uri, self.name, self.state, self.reason) != (other.uri, other.name, other.state, other.reason):
+                return False
+            if self._pidf_source is not None and other._pidf_source is not None:
+                # avoid parsing the PIDF documents when the payloads they came from are available
+                return self._pidf_source == other._pidf_source
+            return self.pidf_list == other.pidf_list
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return NotImplemented if equal is NotImplemented else not equal
+
+    @property
+    def pidf_list(self):
+        # the deferred payloads are only discarded once all of them were parsed and added to the list
+        if self._pidf_payloads:
+            with self._pidf_lock:
+                if self._pidf_payloads:
+                    self._pidf_list.extend(list(self._parse_pidf_payloads(self._pidf_payloads)))
+                    self._pidf_payloads = None
+        return self._pidf_list
+
+    @pidf_list.setter
+    def pidf_list(self, pidf_list):
+        self._pidf_list = pidf_list
+        self._pidf_payloads = None
+        self._pidf_source = None
+
+    @staticmethod
+    def _parse_pidf_payloads(payloads):
+        for payload in payloads:
+            try:
+                yield pidf.PIDFDocument.parse(payload)
+            except ParserError:
+                pass
+
     @classmethod
-    def from_payload(cls, xml_element, payload_map):
+    def from_payload(cls, xml_element, payload_map, defer_pidf=False):
         try:
             name = next(element for element in xml_element if isinstance(element, rlmi.Name))
         except StopIteration:
@@ -47,17 +149,19 @@ class Resource(object):
             instance = sorted(instances, key=lambda item: cls.__prioritymap__[item.state])[0]
             state = instance.state
             reason = instance.reason
-        pidf_list = []
+        payloads = []
         for instance in (instance for instance in instances if instance.cid is not None):
             try:
-                payload = payload_map['<%s>' % instance.cid].get_payload()
+                payloads.append(payload_map['<%s>' % instance.cid].get_payload())
             except KeyError:
                 continue
-            try:
-                pidf_list.append(pidf.PIDFDocument.parse(payload))
-            except ParserError:
-                pass
-        return cls(xml_element.uri, name, state, reason, pidf_list)
+        resource = cls(xml_element.uri, name, state, reason)
+        if defer_pidf:
+            resource._pidf_payloads = payloads
+        else:
+            resource.pidf_list = list(cls._parse_pidf_payloads(payloads))
+        resource._pidf_source = payloads
+        return resource
 
 
 class RLSNotify(object):
@@ -72,17 +176,48 @@ class RLSNotify(object):
         self.resources = resources
 
     def __iter__(self):
-        return iter(self.resources)
+        # resources are created as they are iterated over, the ones already created are kept in self._resources
+        index = 0
+        while True:
+            if index == len(self._resources):
+                try:
+                    self._resources.append(next(self._pending_resources))
+                except StopIteration:
+                    return
+            yield self._resources[index]
+            index += 1
 
     def __len__(self):
         return len(self.resources)
 
+    @property
+    def resources(self):
+        self._resources.extend(self._pending_resources)
+        return self._resources
+
+    @resources.setter
+    def resources(self, resources):
+        self._resources = []
+        self._pending_resources = iter(resources)
+
     @classmethod
-    def parse(cls, payload):
-        message = email.message_from_string(payload)
+    def parse(cls, payload, defer_pidf=False):
+        """
+        Parse an RLS notify body, prefixed by its Content-Type header and an
+        empty line. The body is split in a single pass and the resources are
+        created as they are iterated over. If defer_pidf is True, the PIDF
+        documents of a resource are only parsed when its pidf_list attribute
+        is first accessed. This is only meant for resources used by the code
+        which parses them, the ones handed to others, like the ones sent in
+        notifications, should have their PIDF documents parsed right away.
+        """
+        match = MultipartPart.header_separator_re.search(payload)
+        body_start = match.end() if match is not None else len(payload)
+        message = email.message_from_string(payload[:body_start])
         if message.get_content_type() != cls.content_type:
             raise ParserError("expected multipart/related content, got %s" % message.get_content_type())
-        payloads = message.get_payload()
+        boundary = message.get_boundary()
+        payloads = list(MultipartPart.split(payload, boundary, body_start)) if boundary else []
         if len(payloads) == 0:
             raise ParserError("multipart/related body contains no parts")
         payload_map = dict((payload['Content-ID'], payload) for payload in payloads if payload['Content-ID'] is not None)
@@ -98,7 +233,7 @@ class RLSNotify(object):
         if root_type != rlmi.RLMIDocument.content_type != root.get_content_type():
             raise ParserError("the multipart/related root element must be of type %s" % rlmi.RLMIDocument.content_type)
         rlmi_document = rlmi.RLMIDocument.parse(root.get_payload())
-        resources = [Resource.from_payload(xml_element, payload_map) for xml_element in rlmi_document[rlmi.Resource, IterateItems]]
+        resources = (Resource.from_payload(xml_element, payload_map, defer_pidf) for xml_element in rlmi_document[rlmi.Resource, IterateItems])
         return cls(rlmi_document.uri, rlmi_document.version, rlmi_document.full_state, resources)
 
 
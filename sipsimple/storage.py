@@ -1,7 +1,7 @@
 
 """Definitions and implementations of storage backends"""
 
-__all__ = ['ISIPSimpleStorage', 'ISIPSimpleApplicationDataStorage', 'FileStorage', 'MemoryStorage']
+__all__ = ['ISIPSimpleStorage', 'ISIPSimpleApplicationDataStorage', 'FileStorage', 'JournalFileStorage', 'MemoryStorage']
 
 import os
 
@@ -11,6 +11,7 @@ from zope.interface import Attribute, Interface, implements
 from sipsimple.account.xcap.storage.file import FileStorage as XCAPFileStorage
 from sipsimple.account.xcap.storage.memory import MemoryStorage as XCAPMemoryStorage
 from sipsimple.configuration.backend.file import FileBackend as ConfigurationFileBackend
+from sipsimple.configuration.backend.journal import JournalBackend as ConfigurationJournalBackend
 from sipsimple.configuration.backend.memory import MemoryBackend as ConfigurationMemoryBackend
 
 
@@ -32,8 +33,19 @@ class FileStorage(object):
 
     implements(ISIPSimpleStorage, ISIPSimpleApplicationDataStorage)
 
-    def __init__(self, directory):
-        self.configuration_backend = ConfigurationFileBackend(os.path.join(directory, 'config'))
+    def __init__(self, directory, cache=False):
+        self.configuration_backend = ConfigurationFileBackend(os.path.join(directory, 'config'), cache=cache)
+        self.xcap_storage_factory  = partial(XCAPFileStorage, os.path.join(directory, 'xcap'))
+        self.directory = directory
+
+
+class JournalFileStorage(object):
+    """Store/read SIP Simple data to/from files, journaling configuration changes"""
+
+    implements(ISIPSimpleStorage, ISIPSimpleApplicationDataStorage)
+
+    def __init__(self, directory, cache=False, compaction_size=1024*1024, compaction_interval=3600):
+        self.configuration_backend = ConfigurationJournalBackend(os.path.join(directory, 'config'), cache=cache, compaction_size=compaction_size, compaction_interval=compaction_interval)
         self.xcap_storage_factory  = partial(XCAPFileStorage, os.path.join(directory, 'xcap'))
         self.directory = directory
 
@@ -15,16 +15,17 @@ import time
 import uuid
 
 from abc import ABCMeta, abstractmethod
+from application import log
 from application.notification import NotificationCenter, NotificationData, IObserver
 from application.python.threadpool import ThreadPool, run_in_threadpool
 from application.python.types import MarkerType
 from application.system import FileExistsError, makedirs, openfile, unlink
+from collections import deque
 from itertools import count
 from msrplib.protocol import MSRPHeader, FailureReportHeader, SuccessReportHeader, ContentTypeHeader
 from msrplib.session import MSRPSession
 from msrplib.transport import make_response
-from Queue import Queue
-from threading import Event, Lock
+from threading import Condition, Event, Lock
 from zope.interface import implements
 
 from sipsimple.configuration.settings import SIPSimpleSettings
@@ -33,7 +34,7 @@ from sipsimple.storage import ISIPSimpleApplicationDataStorage
 from sipsimple.streams import InvalidStreamError, UnknownStreamError
 from sipsimple.streams.msrp import MSRPStreamBase
 from sipsimple.threading import run_in_twisted_thread, run_in_thread
-from sipsimple.util import sha1
+from sipsimple.util import monotonic, sha1
 
 
 HASH = type(hashlib.sha1())
@@ -206,6 +207,134 @@ class FileTransfersMetadata(object):
         self.lock.release()
 
 
+class FileHashIndex(object):
+    """
+    Persistent index of the hashes computed for the files which were sent,
+    so that an unmodified file doesn't have to be read in full before it can
+    be sent again. The hashes are keyed by the path, device, inode, size and
+    modification time of the file and are dropped when they were not used
+    for __lifetime__ seconds, or when the index grows beyond __max_entries__.
+    """
+
+    __filename__ = 'transfer_hashes'
+    __lifetime__ = 60*60*24*30
+    __max_entries__ = 1000
+
+    def __init__(self):
+        self.data = {}
+        self.lock = Lock()
+        self.loaded = False
+        self.directory = None
+
+    @staticmethod
+    def make_key(file_selector):
+        try:
+            file_stat = os.fstat(file_selector.fd.fileno())
+            return os.path.abspath(file_selector.name), file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime
+        except (AttributeError, EnvironmentError, TypeError, ValueError):
+            return None
+
+    def get(self, key):
+        with self.lock:
+            self._load()
+            try:
+                hash, last_used = self.data[key]
+            except KeyError:
+                return None
+            self.data[key] = hash, time.time()
+            return hash
+
+    def add(self, key, hash):
+        now = time.time()
+        if now - key[4] < 2:
+            # the file could still be modified within the resolution of its modification time without the key changing
+            return
+        with self.lock:
+            self._load()
+            self.data[key] = str(hash), now
+            if len(self.data) > self.__max_entries__:
+                for old_key in sorted(self.data, key=lambda item: self.data[item][1])[:len(self.data)-self.__max_entries__]:
+                    del self.data[old_key]
+            self._save(pickle.dumps(self.data))
+
+    def _load(self):
+        if self.loaded:
+            return
+        from sipsimple.application import SIPApplication
+        if ISIPSimpleApplicationDataStorage.providedBy(SIPApplication.storage):
+            self.directory = SIPApplication.storage.directory
+        if self.directory is not None:
+            try:
+                with open(os.path.join(self.directory, self.__filename__), 'rb') as f:
+                    data = pickle.loads(f.read())
+            except Exception:
+                data = {}
+            now = time.time()
+            self.data.update((key, entry) for key, entry in data.iteritems() if now - entry[1] <= self.__lifetime__)
+        self.loaded = True
+
+    @run_in_thread('file-io')
+    def _save(self, data):
+        if self.directory is not None:
+            with open(os.path.join(self.directory, self.__filename__), 'wb') as f:
+                f.write(data)
+
+
+class ProgressTracker(object):
+    """
+    Limits the rate of the progress notifications of a transfer or of a hash
+    computation according to the file transfer settings: an update is reported
+    when progress_interval seconds passed, when the progress crossed a multiple
+    of progress_step percent or when progress_bytes bytes were processed since
+    the last reported update, whichever happens first. When none of them is
+    set every update is reported. The update which completes the operation is
+    always reported and flush reports the last update if it was not reported.
+
+    After an update was reported, rate holds the throughput since the previous
+    reported update and average_rate the throughput since the tracker was
+    created, both in bytes per second.
+    """
+
+    def __init__(self, processed=0):
+        settings = SIPSimpleSettings()
+        self.interval = settings.file_transfer.progress_interval
+        self.step = settings.file_transfer.progress_step
+        self.bytes = settings.file_transfer.progress_bytes
+        self.processed = self.start_processed = self.last_processed = processed
+        self.total = None
+        self.start_time = self.last_time = monotonic()
+        self.rate = 0.0
+        self.average_rate = 0.0
+
+    def update(self, processed, total):
+        self.processed = processed
+        self.total = total
+        now = monotonic()
+        if self.interval is self.step is self.bytes is None or (total is not None and processed >= total):
+            due = True
+        else:
+            due = self.interval is not None and now - self.last_time >= self.interval
+            due = due or self.bytes is not None and processed - self.last_processed >= self.bytes
+            due = due or self.step is not None and bool(total) and 100*processed // (self.step*total) != 100*self.last_processed // (self.step*total)
+        if due:
+            self._mark(now)
+        return due
+
+    def flush(self):
+        if self.processed == self.last_processed:
+            return False
+        self._mark(monotonic())
+        return True
+
+    def _mark(self, now):
+        elapsed = now - self.last_time
+        self.rate = (self.processed - self.last_processed) / elapsed if elapsed > 0 else 0.0
+        elapsed = now - self.start_time
+        self.average_rate = (self.processed - self.start_processed) / elapsed if elapsed > 0 else 0.0
+        self.last_time = now
+        self.last_processed = self.processed
+
+
 class FileTransferHandler(object):
     __metaclass__ = ABCMeta
 
@@ -307,15 +436,82 @@ class FileTransferHandler(object):
 class EndTransfer: __metaclass__ = MarkerType
 
 
+class FileWriteScheduler(object):
+    """
+    Schedules the disk writes of the incoming file transfers on a thread pool,
+    which must not be shared with code that blocks, like the outgoing file
+    transfers that wait for their chunks to be acknowledged.
+
+    Instead of occupying a thread for its whole duration, a transfer only
+    uses a pool thread while it has chunks waiting to be written, so slow
+    peers do not hold on to threads which other transfers could use. The
+    transfers with pending chunks are served in round-robin order, each one
+    writing at most quantum bytes per turn, by at most max_writers threads.
+    The chunks of a transfer are always written by one thread at a time, in
+    the order in which they were received.
+    """
+
+    quantum = 1024*1024
+    max_writers = 8
+
+    def __init__(self, threadpool):
+        self.threadpool = threadpool
+        self.ready = deque()
+        self.writers = 0
+        self.lock = Lock()
+
+    def add(self, handler, chunk):
+        with self.lock:
+            handler.pending_chunks.append(chunk)
+            if handler.scheduled:
+                return
+            handler.scheduled = True
+            self.ready.append(handler)
+            if self.writers == self.max_writers:
+                return
+            self.writers += 1
+        self.threadpool.run(self._run)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.ready:
+                    self.writers -= 1
+                    return
+                handler = self.ready.popleft()
+                chunks = []
+                size = 0
+                while handler.pending_chunks and size < self.quantum:
+                    chunk = handler.pending_chunks.popleft()
+                    chunks.append(chunk)
+                    size += chunk.size if chunk is not EndTransfer else 0
+            try:
+                handler._write_chunks(chunks)
+            except Exception:
+                log.err()
+            with self.lock:
+                if handler.pending_chunks:
+                    self.ready.append(handler)
+                else:
+                    handler.scheduled = False
+
+
 class IncomingFileTransferHandler(FileTransferHandler):
     metadata = FileTransfersMetadata()
 
+    write_threadpool = ThreadPool(name='FileTransferWrites', min_threads=0, max_threads=FileWriteScheduler.max_writers)
+    write_threadpool.start()
+    write_scheduler = FileWriteScheduler(write_threadpool)
+
     def __init__(self):
         super(IncomingFileTransferHandler, self).__init__()
         self.hash = sha1()
-        self.queue = Queue()
         self.offset = 0
         self.received_chunks = 0
+        self.pending_chunks = deque()
+        self.scheduled = False
+        self._done = False
+        self._progress = None
 
     def _get_save_directory(self):
         return self.__dict__.get('save_directory')
@@ -335,6 +531,8 @@ class IncomingFileTransferHandler(FileTransferHandler):
             makedirs(directory)
             with self.metadata as metadata:
                 try:
+                    if stream.file_selector.hash is None:
+                        raise KeyError('cannot resume a transfer without a hash')
                     prev_file = metadata.pop(stream.file_selector.hash.lower())
                     mtime = os.path.getmtime(prev_file.filename)
                     if mtime != prev_file.mtime:
@@ -365,7 +563,7 @@ class IncomingFileTransferHandler(FileTransferHandler):
             NotificationCenter().post_notification('FileTransferHandlerDidInitialize', sender=self)
 
     def end(self):
-        self.queue.put(EndTransfer)
+        self.write_scheduler.add(self, EndTransfer)
 
     def process_chunk(self, chunk):
         if chunk.method == 'SEND':
@@ -375,7 +573,7 @@ class IncomingFileTransferHandler(FileTransferHandler):
                 self.hash = sha1()
                 self.offset = 0
             self.received_chunks += 1
-            self.queue.put(chunk)
+            self.write_scheduler.add(self, chunk)
         elif chunk.method == 'FILE_OFFSET':
             if self.received_chunks > 0:
                 response = make_response(chunk, 413, 'Unwanted message')
@@ -385,20 +583,28 @@ class IncomingFileTransferHandler(FileTransferHandler):
                 response.headers['Offset'] = MSRPHeader('Offset', offset)
             self.stream.msrp_session.send_chunk(response)
 
-    @run_in_threadpool(FileTransferHandler.threadpool)
     def start(self):
+        NotificationCenter().post_notification('FileTransferHandlerDidStart', sender=self)
+
+    def _write_chunks(self, chunks):
+        # called by the write scheduler, from a thread pool
+        if self._done:
+            return
         notification_center = NotificationCenter()
-        notification_center.post_notification('FileTransferHandlerDidStart', sender=self)
         file_selector = self.stream.file_selector
         fd = file_selector.fd
 
-        while True:
-            chunk = self.queue.get()
+        for chunk in chunks:
             if chunk is EndTransfer:
+                progress = self._progress
+                if progress is not None and progress.flush():
+                    notification_center.post_notification('FileTransferHandlerProgress', sender=self, data=NotificationData(transferred_bytes=progress.processed, total_bytes=progress.total,
+                                                                                                                          rate=progress.rate, average_rate=progress.average_rate))
                 break
             try:
                 fd.write(chunk.data)
             except EnvironmentError, e:
+                self._done = True
                 fd.close()
                 notification_center.post_notification('FileTransferHandlerError', sender=self, data=NotificationData(error=str(e)))
                 notification_center.post_notification('FileTransferHandlerDidEnd', sender=self, data=NotificationData(error=True, reason=str(e)))
@@ -407,10 +613,17 @@ class IncomingFileTransferHandler(FileTransferHandler):
             self.offset += chunk.size
             transferred_bytes = chunk.byte_range[0] + chunk.size - 1
             total_bytes = file_selector.size = chunk.byte_range[2]
-            notification_center.post_notification('FileTransferHandlerProgress', sender=self, data=NotificationData(transferred_bytes=transferred_bytes, total_bytes=total_bytes))
+            if self._progress is None:
+                self._progress = ProgressTracker(chunk.byte_range[0] - 1)
+            if self._progress.update(transferred_bytes, total_bytes):
+                notification_center.post_notification('FileTransferHandlerProgress', sender=self, data=NotificationData(transferred_bytes=transferred_bytes, total_bytes=total_bytes,
+                                                                                                                      rate=self._progress.rate, average_rate=self._progress.average_rate))
             if transferred_bytes == total_bytes:
                 break
+        else:
+            return
 
+        self._done = True
         fd.close()
 
         # Transfer is finished
@@ -418,7 +631,7 @@ class IncomingFileTransferHandler(FileTransferHandler):
         if self.offset != self.stream.file_selector.size:
             notification_center.post_notification('FileTransferHandlerDidEnd', sender=self, data=NotificationData(error=True, reason='Incomplete file'))
             return
-        if self.hash != self.stream.file_selector.hash:
+        if self.stream.file_selector.hash is not None and self.hash != self.stream.file_selector.hash:
             unlink(self.filename)  # something got corrupted, better delete the file
             notification_center.post_notification('FileTransferHandlerDidEnd', sender=self, data=NotificationData(error=True, reason='File hash mismatch'))
             return
@@ -447,6 +660,7 @@ class IncomingFileTransferHandler(FileTransferHandler):
 
 class OutgoingFileTransferHandler(FileTransferHandler):
     file_part_size = 64*1024
+    hash_index = FileHashIndex()
 
     def __init__(self):
         super(OutgoingFileTransferHandler, self).__init__()
@@ -456,6 +670,10 @@ class OutgoingFileTransferHandler(FileTransferHandler):
         self.message_id = '%x' % random.getrandbits(64)
         self.offset = 0
         self.headers = {}
+        self.chunks_in_flight = 0
+        self._window_condition = Condition()
+        self._hash_key = None
+        self._progress = None
 
     def initialize(self, stream, session):
         super(OutgoingFileTransferHandler, self).initialize(stream, session)
@@ -471,8 +689,20 @@ class OutgoingFileTransferHandler(FileTransferHandler):
         self.headers[FailureReportHeader.name] = FailureReportHeader('yes')
 
         if stream.file_selector.hash is None:
+            self._lookup_file_hash(stream.file_selector)
+        else:
+            NotificationCenter().post_notification('FileTransferHandlerDidInitialize', sender=self)
+
+    @run_in_thread('file-io')
+    def _lookup_file_hash(self, file_selector):
+        # the hash index is read from disk when it is first used
+        self._hash_key = self.hash_index.make_key(file_selector)
+        if self._hash_key is not None:
+            file_selector.hash = self.hash_index.get(self._hash_key)
+        if file_selector.hash is None and SIPSimpleSettings().file_transfer.precompute_hash:
             self._calculate_file_hash()
         else:
+            # either the hash is known or precompute_hash is disabled, in which case the file is offered without a hash and it is computed while sending
             NotificationCenter().post_notification('FileTransferHandlerDidInitialize', sender=self)
 
     @run_in_threadpool(FileTransferHandler.threadpool)
@@ -481,10 +711,11 @@ class OutgoingFileTransferHandler(FileTransferHandler):
         processed = 0
 
         notification_center = NotificationCenter()
-        notification_center.post_notification('FileTransferHandlerHashProgress', sender=self, data=NotificationData(processed=0, total=self.stream.file_selector.size))
+        notification_center.post_notification('FileTransferHandlerHashProgress', sender=self, data=NotificationData(processed=0, total=self.stream.file_selector.size, rate=0.0, average_rate=0.0))
 
         file_selector = self.stream.file_selector
         fd = file_selector.fd
+        progress = ProgressTracker()
         while not self.stop_event.is_set():
             try:
                 content = fd.read(self.file_part_size)
@@ -493,12 +724,17 @@ class OutgoingFileTransferHandler(FileTransferHandler):
                 notification_center.post_notification('FileTransferHandlerDidNotInitialize', sender=self, data=NotificationData(reason=str(e)))
                 return
             if not content:
+                if progress.flush():
+                    notification_center.post_notification('FileTransferHandlerHashProgress', sender=self, data=NotificationData(processed=processed, total=file_selector.size, rate=progress.rate, average_rate=progress.average_rate))
                 file_selector.hash = file_hash
+                if self._hash_key is not None:
+                    self.hash_index.add(self._hash_key, file_selector.hash)
                 notification_center.post_notification('FileTransferHandlerDidInitialize', sender=self)
                 break
             file_hash.update(content)
             processed += len(content)
-            notification_center.post_notification('FileTransferHandlerHashProgress', sender=self, data=NotificationData(processed=processed, total=file_selector.size))
+            if progress.update(processed, file_selector.size):
+                notification_center.post_notification('FileTransferHandlerHashProgress', sender=self, data=NotificationData(processed=processed, total=file_selector.size, rate=progress.rate, average_rate=progress.average_rate))
         else:
             fd.close()
             notification_center.post_notification('FileTransferHandlerDidNotInitialize', sender=self, data=NotificationData(reason='Interrupted transfer'))
@@ -506,6 +742,8 @@ class OutgoingFileTransferHandler(FileTransferHandler):
     def end(self):
         self.stop_event.set()
         self.file_offset_event.set()    # in case we are busy waiting on it
+        with self._window_condition:
+            self._window_condition.notify()
 
     @run_in_threadpool(FileTransferHandler.threadpool)
     def start(self):
@@ -516,21 +754,38 @@ class OutgoingFileTransferHandler(FileTransferHandler):
             self._send_file_offset_chunk()
             self.file_offset_event.wait()
 
+        settings = SIPSimpleSettings()
+        chunk_size = settings.file_transfer.chunk_size
+        send_window = settings.file_transfer.send_window
+
         finished = False
         failure_reason = None
+        self._progress = ProgressTracker(self.offset)
         fd = self.stream.file_selector.fd
+        file_hash = hashlib.sha1() if self.stream.file_selector.hash is None and self._hash_key is not None and self.offset == 0 else None
         fd.seek(self.offset)
 
         try:
             while not self.stop_event.is_set():
+                # only read the next chunk after the transaction of one of the last send_window chunks completes, which
+                # keeps the data queued for the transport bounded no matter how much faster the file can be read
+                with self._window_condition:
+                    while self.chunks_in_flight >= send_window and not self.stop_event.is_set():
+                        self._window_condition.wait()
+                    if self.stop_event.is_set():
+                        break
+                    self.chunks_in_flight += 1
                 try:
-                    data = fd.read(self.file_part_size)
+                    data = fd.read(chunk_size)
                 except EnvironmentError, e:
                     failure_reason = str(e)
                     break
                 if not data:
+                    self._complete_chunk()
                     finished = True
                     break
+                if file_hash is not None:
+                    file_hash.update(data)
                 self._send_chunk(data)
         finally:
             fd.close()
@@ -539,6 +794,9 @@ class OutgoingFileTransferHandler(FileTransferHandler):
             notification_center.post_notification('FileTransferHandlerDidEnd', sender=self, data=NotificationData(error=True, reason=failure_reason or 'Interrupted transfer'))
             return
 
+        if file_hash is not None:
+            self.hash_index.add(self._hash_key, FileSelectorHash(file_hash))
+
         # Wait until the stream ends or we get all reports
         self.stop_event.wait()
         if self.finished_event.is_set():
@@ -546,7 +804,13 @@ class OutgoingFileTransferHandler(FileTransferHandler):
         else:
             notification_center.post_notification('FileTransferHandlerDidEnd', sender=self, data=NotificationData(error=True, reason='Incomplete transfer'))
 
+    def _complete_chunk(self):
+        with self._window_condition:
+            self.chunks_in_flight -= 1
+            self._window_condition.notify()
+
     def _on_transaction_response(self, response):
+        self._complete_chunk()
         if self.stop_event.is_set():
             return
         if response.code != 200:
@@ -556,6 +820,7 @@ class OutgoingFileTransferHandler(FileTransferHandler):
     @run_in_twisted_thread
     def _send_chunk(self, data):
         if self.stop_event.is_set():
+            self._complete_chunk()
             return
         data_len = len(data)
         chunk = self.stream.msrp.make_send_request(message_id=self.message_id,
@@ -567,6 +832,7 @@ class OutgoingFileTransferHandler(FileTransferHandler):
         try:
             self.stream.msrp_session.send_chunk(chunk, response_cb=self._on_transaction_response)
         except Exception, e:
+            self._complete_chunk()
             NotificationCenter().post_notification('FileTransferHandlerError', sender=self, data=NotificationData(error=str(e)))
         else:
             self.offset += data_len
@@ -598,7 +864,11 @@ class OutgoingFileTransferHandler(FileTransferHandler):
         if chunk.status.code == 200:
             transferred_bytes = chunk.byte_range[1]
             total_bytes = chunk.byte_range[2]
-            notification_center.post_notification('FileTransferHandlerProgress', sender=self, data=NotificationData(transferred_bytes=transferred_bytes, total_bytes=total_bytes))
+            if self._progress is None:
+                self._progress = ProgressTracker()
+            if self._progress.update(transferred_bytes, total_bytes):
+                notification_center.post_notification('FileTransferHandlerProgress', sender=self, data=NotificationData(transferred_bytes=transferred_bytes, total_bytes=total_bytes,
+                                                                                                                      rate=self._progress.rate, average_rate=self._progress.average_rate))
             if transferred_bytes == total_bytes:
                 self.finished_event.set()
                 self.end()
@@ -326,6 +326,10 @@ class RTPStream(object):
     def statistics(self):
         return self._transport.statistics if self._transport else None
 
+    @property
+    def statistics_sample(self):
+        return self._transport.statistics_sample if self._transport else None
+
     @property
     def local_rtp_address(self):
         return self._rtp_transport.local_rtp_address if self._rtp_transport else None
@@ -0,0 +1,181 @@
+
+"""Periodic sampling of the RTP statistics of the active streams"""
+
+__all__ = ['RTPStatisticsHistory', 'RTPStatisticsSampler']
+
+from array import array
+from math import ceil
+from threading import Lock
+from time import time
+from weakref import WeakKeyDictionary
+
+from application.notification import IObserver, NotificationCenter
+from application.python import Null
+from application.python.types import Singleton
+from twisted.internet import reactor
+from zope.interface import implements
+
+from sipsimple.core import SIPCoreError
+from sipsimple.session import SessionManager
+from sipsimple.streams.rtp import RTPStream
+from sipsimple.threading import run_in_twisted_thread
+
+
+class RTPStatisticsHistory(object):
+    """
+    Ring buffer holding the last size statistics samples taken for a stream.
+
+    Each sample holds the values of the fields below: the round trip time and
+    the jitter are the last values measured (in microseconds), the packet,
+    byte and loss counters are cumulative and rx_loss_rate is the fraction of
+    the expected packets which were lost since the stream started.
+    """
+
+    fields = ('rtt', 'rx_packets', 'rx_bytes', 'rx_lost', 'rx_discarded', 'rx_jitter', 'tx_packets', 'tx_bytes', 'tx_lost', 'tx_jitter', 'rx_loss_rate')
+
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self._timestamps = array('d', [0]) * size
+        self._values = array('d', [0]) * (size * len(self.fields))
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def add(self, timestamp, sample):
+        index = self.count % self.size
+        width = len(self.fields)
+        self._timestamps[index] = timestamp
+        self._values[index*width:(index+1)*width] = array('d', sample)
+        self.count += 1
+
+    def series(self, field, since=None):
+        """Return the (timestamp, value) pairs for field, oldest first"""
+        column = self.fields.index(field)
+        width = len(self.fields)
+        indexes = [index % self.size for index in xrange(self.count - len(self), self.count)]
+        return [(self._timestamps[index], self._values[index*width + column]) for index in indexes if since is None or self._timestamps[index] >= since]
+
+    @property
+    def latest(self):
+        if not self.count:
+            return None
+        index = (self.count - 1) % self.size
+        width = len(self.fields)
+        return dict(zip(self.fields, self._values[index*width:(index+1)*width]), timestamp=self._timestamps[index])
+
+
+class RTPStatisticsSampler(object):
+    """
+    Periodically collects the RTP statistics of all the active RTP streams in
+    one pass and keeps the last history_size samples of each stream.
+
+    The statistics are collected as compact tuples of numbers rather than the
+    nested dictionaries returned by RTPStream.statistics, and the stream locks
+    are only held while the statistics are copied. The history of a stream is
+    kept after it ends, for as long as the stream object is alive.
+    """
+
+    __metaclass__ = Singleton
+
+    implements(IObserver)
+
+    interval = 5
+    history_size = 120
+
+    def __init__(self):
+        self.streams = set()
+        self.histories = WeakKeyDictionary()
+        self.started = False
+        self._lock = Lock()
+        self._timer = None
+
+    @run_in_twisted_thread
+    def start(self, interval=None):
+        if self.started:
+            return
+        if interval is not None:
+            self.interval = interval
+        self.started = True
+        with self._lock:
+            self.streams.update(stream for session in SessionManager().sessions for stream in session.streams or [] if isinstance(stream, RTPStream))
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='MediaStreamDidStart')
+        notification_center.add_observer(self, name='MediaStreamDidEnd')
+        self._timer = reactor.callLater(self.interval, self._sample)
+
+    @run_in_twisted_thread
+    def stop(self):
+        if not self.started:
+            return
+        self.started = False
+        notification_center = NotificationCenter()
+        notification_center.remove_observer(self, name='MediaStreamDidStart')
+        notification_center.remove_observer(self, name='MediaStreamDidEnd')
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        with self._lock:
+            self.streams.clear()
+
+    def get_history(self, stream):
+        return self.histories.get(stream)
+
+    def series(self, stream, field, since=None):
+        """Return the (timestamp, value) pairs sampled for field on stream, oldest first"""
+        with self._lock:
+            history = self.histories.get(stream)
+            return history.series(field, since) if history is not None else []
+
+    def percentiles(self, field, percentiles=(50, 90, 95, 99), window=None):
+        """
+        Return a dictionary mapping the requested percentiles to the values of
+        field across all the active streams. Only the latest sample of each
+        stream is considered, unless a window (in seconds) is given, in which
+        case all the samples taken during the window are.
+        """
+        since = time() - window if window is not None else None
+        values = []
+        with self._lock:
+            for stream in self.streams:
+                history = self.histories.get(stream)
+                if history is None or not history.count:
+                    continue
+                if since is None:
+                    values.append(history.latest[field])
+                else:
+                    values.extend(value for timestamp, value in history.series(field, since))
+        values.sort()
+        return dict((percentile, values[max(int(ceil(percentile / 100.0 * len(values))) - 1, 0)] if values else None) for percentile in percentiles)
+
+    def _sample(self):
+        now = time()
+        with self._lock:
+            for stream in list(self.streams):
+                try:
+                    sample = stream.statistics_sample
+                except SIPCoreError:
+                    sample = None
+                if sample is None:
+                    continue
+                rx_packets, rx_lost = sample[1], sample[3]
+                history = self.histories.get(stream)
+                if history is None:
+                    history = self.histories[stream] = RTPStatisticsHistory(self.history_size)
+                history.add(now, sample + (float(rx_lost) / (rx_packets + rx_lost) if rx_packets + rx_lost else 0,))
+        self._timer = reactor.callLater(self.interval, self._sample)
+
+    @run_in_twisted_thread
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_MediaStreamDidStart(self, notification):
+        if self.started and isinstance(notification.sender, RTPStream):
+            with self._lock:
+                self.streams.add(notification.sender)
+
+    def _NH_MediaStreamDidEnd(self, notification):
+        with self._lock:
+            self.streams.discard(notification.sender)
+
@@ -3,11 +3,12 @@
 
 from __future__ import absolute_import
 
-__all__ = ["All", "Any", "ExponentialTimer", "ISOTimestamp", "MultilingualText", "user_info", "sha1"]
+__all__ = ["All", "Any", "ExponentialTimer", "ISOTimestamp", "MultilingualText", "monotonic", "user_info", "sha1"]
 
 import os
 import platform
 import sys
+import time
 import dateutil.parser
 
 from application.notification import NotificationCenter
@@ -115,6 +116,41 @@ class ExponentialTimer(object):
         self._limit_timer = None
 
 
+# Utility functions
+#
+
+def _get_monotonic_clock():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    import ctypes
+    import ctypes.util
+    system = platform.system()
+    try:
+        if system == 'Windows':
+            get_tick_count = ctypes.windll.kernel32.GetTickCount64
+            get_tick_count.restype = ctypes.c_ulonglong
+            return lambda: get_tick_count() / 1000.0
+        clock_id = {'Linux': 1, 'Darwin': 6, 'FreeBSD': 4}[system]
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        library = ctypes.util.find_library('c') if system != 'Linux' else ctypes.util.find_library('rt') or ctypes.util.find_library('c')
+        clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    except (AttributeError, KeyError, OSError):
+        return time.time
+    def monotonic():
+        value = timespec()
+        if clock_gettime(clock_id, ctypes.byref(value)) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return value.tv_sec + value.tv_nsec / 1e9
+    return monotonic
+
+# monotonic() returns the value in seconds of a clock that cannot go backwards
+monotonic = _get_monotonic_clock()
+del _get_monotonic_clock
+
+
 # Utility objects
 #
 